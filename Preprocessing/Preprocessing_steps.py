@@ -2,6 +2,8 @@ import numpy as np
 import pandas as pd 
 import pydicom
 import os
+import io
+import sys
 import scipy.ndimage
 import matplotlib.pyplot as plt
 import cv2 
@@ -10,6 +12,39 @@ from PIL import Image
 from skimage import measure, morphology
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 from scipy.ndimage import gaussian_filter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from volume_cache import VolumeCache, params_hash
+from run_manifest import RunManifest, fingerprint_folder, fingerprint_file
+from slice_export import SliceExportPool, hu_to_uint16, save_raw_volume, source_slice_positions, resampled_slice_names
+from shard_dataset import ShardWriter
+try:
+    from instrumentation import RunStats, Progress, collect, stage
+except ImportError:
+    # Run from Preprocessing/ alone: the module is shared with the annotation code in the sibling xml_parser folder
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'xml_parser'))
+    from instrumentation import RunStats, Progress, collect, stage
+from annotation import find_xml_file, parse_columnar
+from annotation_cache import load_patient
+from nodule_table import NoduleTable
+from yolo_labels import slice_labels
+
+SMOOTH_THREADS = 1  # Threads per patient for smooth_volume; the patients already run in parallel
+RESAMPLE_ORDER = 1  # Interpolation order of resample_volume in process_patient (zoom defaults to 3)
+# Encoder threads per patient of the JPEG, PNG and shard exports, 1 to encode serially. None shares the CPUs
+# among the worker processes of run_patients (see export_threads), so a pool of cpu_count workers encodes serially.
+EXPORT_THREADS = None
+EXPORT_HU_WINDOW = (-1024.0, 3071.0)  # Fixed HU window of the 16-bit exports, lossless for integer HU
+EXPORT_RAW_DTYPE = 'uint16'  # dtype of the 'raw' export, 'uint16' or 'float16'
+EXPORT_WINDOWS = ('lung', 'mediastinal', 'bone')  # CT_WINDOWS of the RGB channels of the 'windows' export
+ANNOTATION_CACHE = None  # annotation_cache folder for the labels of the 'shards' export, None parses the XML
+LABELLED_FORMATS = ('shards',)  # Export formats whose records carry the labels of the annotation XML file
+
+#--------------------------------------------------------------------------------------------------------------
+
+def export_threads(num_workers=1):
+    # Encoder threads per patient: EXPORT_THREADS, or the CPUs left to each of num_workers worker processes
+    return EXPORT_THREADS or max((os.cpu_count() or 1) // num_workers, 1)
 
 #--------------------------------------------------------------------------------------------------------------
 
@@ -32,8 +67,9 @@ def find_folder_with_max_files(folder_path):
 #--------------------------------------------------------------------------------------------------------------
 
 def load_scan(path):
+    # Pixel data is deferred and only read from disk when pixel_array is accessed
     slices = [
-        (pydicom.read_file(os.path.join(path, s)), s[:-4])  # Remove .dcm extension
+        (pydicom.dcmread(os.path.join(path, s), defer_size="1 KB"), s[:-4])  # Remove .dcm extension
         for s in os.listdir(path) if s.endswith('.dcm')
     ]
     
@@ -55,75 +91,306 @@ def load_scan(path):
 
 #--------------------------------------------------------------------------------------------------------------
 
-def resample(image, scan, new_spacing=[1,1,1]):
-    # Determine current pixel spacing
-    
-    slice_thickness = scan[0].SliceThickness
-    pixel_spacing = scan[0].PixelSpacing
-    
-    # Ensure pixel_spacing is a numpy array
-    if isinstance(pixel_spacing, list):
-        pixel_spacing = np.array(pixel_spacing)
-    elif isinstance(pixel_spacing, np.ndarray):
-        # Ensure pixel_spacing is a 1D array
-        if pixel_spacing.ndim != 1:
-            raise ValueError("PixelSpacing should be a 1D numpy array or a list")
-
-    # Convert slice_thickness to numpy array
-    slice_thickness_array = np.array([slice_thickness])
-
-    # Concatenate slice_thickness_array and pixel_spacing
-    spacing = np.concatenate((slice_thickness_array, pixel_spacing))
-
-    # Convert to float32 for consistency
-    spacing = spacing.astype(np.float32)
+def index_scan(path):
+    """
+    Header-only alternative to load_scan. Reads every slice with stop_before_pixels, so no
+    pixel data is read while sorting the series.
+
+    Returns:
+    - index: List of dictionaries (one per slice, sorted by z position) with the keys
+      'path', 'name' (file name without .dcm), 'sop_uid', 'series_uid', 'z', 'slope',
+      'intercept', 'pixel_spacing', 'shape' ((rows, columns)) and 'slice_thickness'.
+    """
+    index = []
+    for s in os.listdir(path):
+        if not s.endswith('.dcm'):
+            continue
+        file_path = os.path.join(path, s)
+        ds = pydicom.dcmread(file_path, stop_before_pixels=True)
+        if 'ImagePositionPatient' in ds:
+            z = float(ds.ImagePositionPatient[2])
+        else:
+            z = float(ds.SliceLocation)
+        index.append({
+            'path': file_path,
+            'name': s[:-4],  # Remove .dcm extension
+            'sop_uid': ds.get('SOPInstanceUID'),
+            'series_uid': ds.get('SeriesInstanceUID'),
+            'z': z,
+            'slope': float(ds.get('RescaleSlope', 1)),
+            'intercept': float(ds.get('RescaleIntercept', 0)),
+            'pixel_spacing': [float(v) for v in ds.PixelSpacing] if 'PixelSpacing' in ds else None,
+            'shape': (int(ds.get('Rows', 0)), int(ds.get('Columns', 0))),
+        })
+
+    # Sort slices by z position and calculate slice thickness
+    index.sort(key=lambda x: x['z'])
+    slice_thickness = np.abs(index[0]['z'] - index[1]['z']) if len(index) > 1 else 0.
+    for entry in index:
+        entry['slice_thickness'] = slice_thickness
+
+    return index
+
+#--------------------------------------------------------------------------------------------------------------
+
+def read_pixels(index, selection=None):
+    """
+    Reads the raw pixel data of the slices of an index_scan index into one preallocated volume.
+
+    Parameters:
+    - selection: Optional positions in the index of the slices to read (all slices by default).
+    """
+    entries = index if selection is None else [index[i] for i in selection]
+    first = pydicom.dcmread(entries[0]['path']).pixel_array
+    image = np.empty((len(entries),) + first.shape, dtype=first.dtype)
+    image[0] = first
+    for i, entry in enumerate(entries[1:], start=1):
+        image[i] = pydicom.dcmread(entry['path']).pixel_array
+    return image
+
+#--------------------------------------------------------------------------------------------------------------
+
+def scan_spacing(scan):
+    # (z, y, x) spacing of a series from load_scan datasets or an index_scan index
+    first = scan[0]
+    if isinstance(first, dict):
+        slice_thickness, pixel_spacing = first['slice_thickness'], first['pixel_spacing']
+    else:
+        slice_thickness, pixel_spacing = first.SliceThickness, first.PixelSpacing
     
+    # Ensure pixel_spacing is a 1D list of 2 values
+    pixel_spacing = [float(v) for v in pixel_spacing]
+    if len(pixel_spacing) != 2:
+        raise ValueError("PixelSpacing should contain 2 values")
+    return np.array([float(slice_thickness)] + pixel_spacing, dtype=np.float32)
+
+#--------------------------------------------------------------------------------------------------------------
 
-    resize_factor = spacing / new_spacing
-    new_real_shape = image.shape * resize_factor
-    new_shape = np.round(new_real_shape)
-    real_resize_factor = new_shape / image.shape
+def resample(image, scan, new_spacing=[1,1,1], order=3, slab_size=32, num_threads=1):
+    # Determine current pixel spacing
+    spacing = scan_spacing(scan)
+    return resample_volume(image, spacing, new_spacing, order, slab_size, num_threads)
+
+#--------------------------------------------------------------------------------------------------------------
+
+def resampled_shape(shape, spacing, new_spacing=(1, 1, 1)):
+    # Shape of the output of resample_volume for an image of this shape and (z, y, x) spacing
+    resize_factor = np.asarray(spacing, dtype=np.float64) / np.asarray(new_spacing, dtype=np.float64)
+    return np.round(np.array(shape) * resize_factor).astype(int)
+
+#--------------------------------------------------------------------------------------------------------------
+
+def resample_volume(image, spacing, new_spacing=(1, 1, 1), order=1, slab_size=32, num_threads=1):
+    """
+    Resamples a volume to new_spacing like scipy.ndimage.zoom(image, factor, mode='nearest'), writing
+    float32 output slabs of slab_size slices into a preallocated array.
+
+    Each output slab is interpolated from the input slices it maps to plus a halo. For order 1 the
+    result matches zoom, and for order 0 too except where a slice falls exactly halfway between two
+    input slices. For higher orders the spline prefilter only sees the slab and its halo of 12
+    slices, whose influence decays below 1e-4. num_threads > 1 runs the slabs on a thread pool.
+
+    Returns:
+    - (resampled image, actual new spacing)
+    """
+    spacing = np.asarray(spacing, dtype=np.float64)
+    new_shape = resampled_shape(image.shape, spacing, new_spacing)
+    real_resize_factor = new_shape / np.array(image.shape)
     new_spacing = spacing / real_resize_factor
-    
-    image = scipy.ndimage.zoom(image, real_resize_factor, mode='nearest')
-    
-    return image, new_spacing 
+
+    # zoom maps output index o to input coordinate o * (n_in - 1) / (n_out - 1)
+    steps = np.array([(n_in - 1) / (n_out - 1) if n_out > 1 else 0.
+                      for n_in, n_out in zip(image.shape, new_shape)])
+    halo = 1 if order <= 1 else 12
+    out = np.empty(tuple(new_shape), dtype=np.float32)
+
+    def resample_slab(start):
+        stop = min(start + slab_size, new_shape[0])
+        lo = max(int(np.floor(start * steps[0])) - halo, 0)
+        hi = min(int(np.ceil((stop - 1) * steps[0])) + halo + 1, image.shape[0])
+        scipy.ndimage.affine_transform(
+            image[lo:hi], steps, offset=(start * steps[0] - lo, 0., 0.),
+            output_shape=(stop - start,) + tuple(new_shape[1:]), output=out[start:stop],
+            order=order, mode='nearest')
+
+    starts = range(0, new_shape[0], slab_size)
+    if num_threads == 1:
+        for start in starts:
+            resample_slab(start)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(resample_slab, starts))
+    return out, new_spacing.astype(np.float32)
 
 #--------------------------------------------------------------------------------------------------------------
 
+LUNG_WINDOW = (-1000.0, 400.0)
+
+# (min, max) HU bounds of the standard CT windows
+CT_WINDOWS = {
+    'lung': LUNG_WINDOW,            # W 1400, L -300
+    'mediastinal': (-160.0, 240.0), # W 400, L 40
+    'bone': (-450.0, 1050.0),       # W 1500, L 300
+}
+
 def normalize(image):
-    MIN_BOUND = -1000.0
-    MAX_BOUND = 400.0
-    image = (image - MIN_BOUND) / (MAX_BOUND - MIN_BOUND)
-    image[image > 1] = 1.
-    image[image < 0] = 0.
-    return image
+    return apply_window(image, LUNG_WINDOW)
 
 #--------------------------------------------------------------------------------------------------------------
 
-def get_pixels_hounds(slices):
-    image = np.stack([s.pixel_array for s in slices])
-    image = image.astype(np.int16)
-    image[image == -2000] = 0
-
-    for slice_number in range(len(slices)):
-        intercept = slices[slice_number].RescaleIntercept
-        slope = slices[slice_number].RescaleSlope
-        if slope != 1:
-            image[slice_number] = slope * image[slice_number].astype(np.float64)
-            image[slice_number] = image[slice_number].astype(np.int16)
-        image[slice_number] += np.int16(intercept)
-
-    # Normalize the image
-    image = normalize(image)
-    
+def apply_window(image, window=LUNG_WINDOW, out=None):
+    """
+    Maps the HU range of window to [0, 1] and clips, as float32.
+
+    Parameters:
+    - window: (min, max) HU bounds or the name of a window of CT_WINDOWS.
+    - out: Optional float32 output array; pass the image itself to window a float32 volume in place.
+    """
+    min_bound, max_bound = CT_WINDOWS[window] if isinstance(window, str) else window
+    scale = np.float32(1. / (max_bound - min_bound))
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
+    np.subtract(image, np.float32(min_bound), out=out, dtype=np.float32)
+    out *= scale
+    np.clip(out, 0., 1., out=out)
+    return out
+
+#--------------------------------------------------------------------------------------------------------------
+
+def multi_window(image, windows=('lung', 'mediastinal', 'bone'), out=None, slab_size=16):
+    """
+    Applies several windows to an HU volume and stacks them as channels (last axis), e.g. to
+    export the lung, mediastinal and bone windows as the RGB channels of one image.
+
+    The volume is processed in slabs of slab_size slices, so each slab is read once and stays in
+    cache while all windows are computed.
+
+    Returns:
+    - float32 array of shape image.shape + (len(windows),)
+    """
+    windows = [CT_WINDOWS[w] if isinstance(w, str) else w for w in windows]
+    if out is None:
+        out = np.empty(image.shape + (len(windows),), dtype=np.float32)
+    buffer = np.empty((min(slab_size, len(image)),) + image.shape[1:], dtype=np.float32)
+    for start in range(0, len(image), slab_size):
+        stop = min(start + slab_size, len(image))
+        slab = buffer[:stop - start]
+        slab[...] = image[start:stop]
+        for c, window in enumerate(windows):
+            apply_window(slab, window, out=out[start:stop, ..., c])
+    return out
+
+#--------------------------------------------------------------------------------------------------------------
+
+def to_hounds(image, slopes, intercepts, window=None):
+    """
+    Converts a raw pixel volume to Hounsfield units in one pass, broadcasting the per-slice
+    slopes and intercepts over the volume.
+
+    Parameters:
+    - image: Raw pixel volume (slices, rows, columns). Padding pixels (-2000) are treated as 0.
+    - window: Optional (min, max) HU window. When given, the volume is normalized to [0, 1] and
+      clipped in the same pass (as normalize does) and returned as float32.
+
+    Returns:
+    - The volume as int16 when all slopes are 1, the intercepts are integers and the result fits
+      in int16, as float32 otherwise.
+    """
+    slopes = np.asarray(slopes, dtype=np.float32).reshape(-1, 1, 1)
+    intercepts = np.asarray(intercepts, dtype=np.float32).reshape(-1, 1, 1)
+    raw_min, raw_max = int(image.min()), int(image.max())
+    padding = (image == -2000) if raw_min <= -2000 else None
+
+    if window is not None:
+        min_bound, max_bound = window
+        scale = np.float32(1. / (max_bound - min_bound))
+        # (raw * slope + intercept - min) / (max - min), with the constants folded per slice
+        image_scale = slopes * scale
+        offset = (intercepts - np.float32(min_bound)) * scale
+        out = np.multiply(image, image_scale, dtype=np.float32)
+        out += offset
+        if padding is not None:
+            out[padding] = np.broadcast_to(offset, out.shape)[padding]
+        np.clip(out, 0., 1., out=out)
+        return out
+
+    int16 = np.iinfo(np.int16)
+    fits_int16 = (min(raw_min, 0) + int(intercepts.min()) >= int16.min
+                  and max(raw_max, 0) + int(intercepts.max()) <= int16.max
+                  and raw_min >= int16.min and raw_max <= int16.max)
+    if np.all(slopes == 1) and np.all(intercepts == np.round(intercepts)) and fits_int16:
+        out = image.astype(np.int16)
+        if padding is not None:
+            out[padding] = 0
+        out += intercepts.astype(np.int16)
+        return out
+
+    out = image.astype(np.float32)
+    if padding is not None:
+        out[padding] = 0
+    out *= slopes
+    out += intercepts
+    return out
+
+#--------------------------------------------------------------------------------------------------------------
+
+def smooth_volume(image, sigma=1, slab_size=64, num_threads=1, truncate=4.0):
+    """
+    float32 Gaussian smoothing of a volume, computed in overlapping z-slabs.
+
+    Each slab is filtered with a halo of int(truncate * sigma + 0.5) slices on both sides (the
+    radius of the z kernel), so the result matches gaussian_filter on the whole volume while only
+    one slab per thread is held as temporary memory. SciPy releases the GIL while filtering, so
+    num_threads > 1 runs the slabs on a thread pool.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    sigma_z = np.atleast_1d(sigma)[0]
+    halo = int(truncate * float(sigma_z) + 0.5)
+    n = len(image)
+    out = np.empty_like(image)
+
+    def filter_slab(start):
+        stop = min(start + slab_size, n)
+        lo, hi = max(start - halo, 0), min(stop + halo, n)
+        filtered = gaussian_filter(image[lo:hi], sigma, truncate=truncate, output=np.float32)
+        out[start:stop] = filtered[start - lo:stop - lo]
+
+    starts = range(0, n, slab_size)
+    if num_threads == 1:
+        for start in starts:
+            filter_slab(start)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(filter_slab, starts))
+    return out
+
+#--------------------------------------------------------------------------------------------------------------
+
+def smooth(image):
     # Optionally apply zero centering (be cautious with this for CT scans)
     # image = zero_center(image)
 
     # Apply Gaussian filter for smoothing
-    image = gaussian_filter(image, sigma=1)
+    return smooth_volume(image, sigma=1, num_threads=SMOOTH_THREADS)
 
-    return np.array(image, dtype=np.float32)
+#--------------------------------------------------------------------------------------------------------------
+
+def get_pixels_hounds(slices):
+    image = np.stack([s.pixel_array for s in slices])
+    # Convert to HU and normalize to the lung window in one pass
+    image = to_hounds(image, [s.RescaleSlope for s in slices], [s.RescaleIntercept for s in slices],
+                      window=LUNG_WINDOW)
+    return smooth(image)
+
+#--------------------------------------------------------------------------------------------------------------
+
+def get_pixels_hounds_from_index(index, selection=None):
+    # Same as get_pixels_hounds, for an index built by index_scan
+    entries = index if selection is None else [index[i] for i in selection]
+    image = read_pixels(index, selection)
+    image = to_hounds(image, [e['slope'] for e in entries], [e['intercept'] for e in entries],
+                      window=LUNG_WINDOW)
+    return smooth(image)
 
 #--------------------------------------------------------------------------------------------------------------
 
@@ -181,30 +448,197 @@ def segment_lung_mask(image, fill_lung_structures=True):
 
 #--------------------------------------------------------------------------------------------------------------
 
-def process_patient(patient_folder):
-    patient_correct_folder = find_folder_with_max_files(patient_folder)
-    patient = load_scan(patient_correct_folder)
-    
-    slices= [pixel[0] for pixel in patient]
-    # Convert the DICOM slices to pixel data
-    patient_pixels = get_pixels_hounds(slices)
-    
-    # Resample the pixel data
-    #pix_resampled, spacing = resample(first_patient_pixels, first_patient, [1, 1, 1])
-    
+# Full connectivity, as used by measure.label; the 2D structure labels every axial slice in one call
+FULL_3D = scipy.ndimage.generate_binary_structure(3, 3)
+FULL_2D_PER_SLICE = np.stack([np.zeros((3, 3), bool), np.ones((3, 3), bool), np.zeros((3, 3), bool)])
+
+def largest_label(labels, n_labels):
+    # Label (> 0) with the most voxels, using bincount instead of np.unique; None if there is none
+    if n_labels == 0:
+        return None
+    counts = np.bincount(labels.ravel(), minlength=n_labels + 1)
+    return int(np.argmax(counts[1:])) + 1
+
+#--------------------------------------------------------------------------------------------------------------
+
+def segment_lung_mask_fast(image, fill_lung_structures=True, threshold=0.3, border_seeds=True):
+    """
+    Same segmentation as segment_lung_mask using scipy.ndimage.label on boolean masks:
+    - the air around the patient is found from the corners of every axial slice (border_seeds),
+      instead of the single voxel labels[0,0,0], so a tray cutting the air in half is handled;
+    - the largest solid structure of every slice is found with one labeling of the whole volume
+      (no connectivity along z) and bincount;
+    - no int8 +1/-1 copies of the volume are made.
+
+    With border_seeds=False the result is identical to segment_lung_mask.
+    """
+    air = image <= threshold
+    labels, n_labels = scipy.ndimage.label(air, structure=FULL_3D)
+
+    # Fill the air around the person
+    if border_seeds:
+        seeds = labels[:, [0, 0, -1, -1], [0, -1, 0, -1]]
+    else:
+        seeds = labels[0, 0, 0]
+    outside = np.zeros(n_labels + 1, dtype=bool)
+    outside[seeds] = True
+    outside[0] = False
+    air &= ~outside[labels]
+
+    if fill_lung_structures:
+        # For every slice keep the largest solid structure, everything else becomes air
+        labels, n_labels = scipy.ndimage.label(~air, structure=FULL_2D_PER_SLICE)
+        if n_labels > 0:
+            counts = np.bincount(labels.ravel(), minlength=n_labels + 1)
+            slice_of_label = np.zeros(n_labels + 1, dtype=np.intp)
+            slice_of_label[labels] = np.arange(len(labels))[:, None, None]
+            # Sort by (slice, count): the last label of every slice is its largest structure
+            order = np.lexsort((-np.arange(n_labels), counts[1:], slice_of_label[1:])) + 1
+            last_of_slice = np.r_[slice_of_label[order][1:] != slice_of_label[order][:-1], True]
+            keep = np.zeros(n_labels + 1, dtype=bool)
+            keep[order[last_of_slice]] = True
+            air = ~keep[labels]
+
+    # Remove other air pockets insided body, lungs are 1
+    labels, n_labels = scipy.ndimage.label(air, structure=FULL_3D)
+    l_max = largest_label(labels, n_labels)
+    if l_max is not None:
+        return (labels == l_max).astype(np.int8)
+    return air.astype(np.int8)
+
+#--------------------------------------------------------------------------------------------------------------
+
+def preprocessing_params(new_spacing=None):
+    # Parameters that change the intermediates of compute_intermediates, used as VolumeCache key
+    return {
+        'window': LUNG_WINDOW,
+        'sigma': 1,
+        'new_spacing': None if new_spacing is None else [float(v) for v in new_spacing],
+        'resample_order': RESAMPLE_ORDER,
+        'segmentation': 'segment_lung_mask_fast',
+        'fill_lung_structures': False,
+    }
+
+#--------------------------------------------------------------------------------------------------------------
+
+def compute_intermediates(patient, new_spacing=None, keep_hu=False):
+    """
+    Runs the preprocessing of one series indexed by index_scan.
+
+    Returns:
+    - arrays: Dictionary with 'hu' (HU volume, None unless keep_hu or resampling), 'normalized'
+      (smoothed lung window volume) and 'mask' (lung mask).
+    - meta: Dictionary with 'spacing', 'file_names', 'sop_uids' and 'z' (one entry per slice), plus
+      'source_shape' and 'source_z' of the series before resampling. Resampled slices are named
+      "<DICOM file name>_r<index>" and carry the SOP-UID of their nearest DICOM slice (see
+      slice_export.source_slice_name).
+    """
+    slopes = [entry['slope'] for entry in patient]
+    intercepts = [entry['intercept'] for entry in patient]
+    with stage('read_pixels'):
+        image = read_pixels(patient)
+    spacing = scan_spacing(patient)
+    file_name = [entry['name'] for entry in patient]
+    sop_uids = [entry['sop_uid'] for entry in patient]
+    z = [entry['z'] for entry in patient]
+    source_shape, source_z = list(image.shape), z
+
+    hu = None
+    if keep_hu or new_spacing is not None:
+        with stage('hounsfield'):
+            hu = to_hounds(image, slopes, intercepts)
+        # Resample the pixel data, every slice is named after (and given the SOP-UID of) its nearest DICOM slice
+        if new_spacing is not None:
+            with stage('resample'):
+                hu, spacing = resample_volume(hu, spacing, new_spacing, order=RESAMPLE_ORDER)
+            source = source_slice_positions(len(file_name), len(hu)).tolist()
+            file_name = resampled_slice_names(file_name, len(hu))
+            sop_uids = [sop_uids[j] for j in source]
+            z = [patient[0]['z'] + i * float(spacing[0]) for i in range(len(hu))]
+        with stage('hounsfield'):
+            patient_pixels = apply_window(hu, LUNG_WINDOW)
+    else:
+        # Convert to HU and normalize in one pass
+        with stage('hounsfield'):
+            patient_pixels = to_hounds(image, slopes, intercepts, window=LUNG_WINDOW)
+    del image
+    with stage('smooth'):
+        patient_pixels = smooth(patient_pixels)
+
     # Segment the lung mask
-    segmented_lungs = segment_lung_mask(patient_pixels, False)
-    file_name=[fname[1]for fname in patient]
-    return segmented_lungs,file_name
+    with stage('segment'):
+        segmented_lungs = segment_lung_mask_fast(patient_pixels, False)
+    arrays = {'hu': hu, 'normalized': patient_pixels, 'mask': segmented_lungs}
+    meta = {'spacing': [float(v) for v in spacing], 'file_names': file_name, 'sop_uids': sop_uids, 'z': z,
+            'source_shape': source_shape, 'source_z': source_z}
+    return arrays, meta
 
 #--------------------------------------------------------------------------------------------------------------
 
-def to_jpg(pixel_array):
-    # Read the DICOM file
-    pixel_array = pixel_array.astype(np.float32)
+def intermediates_key(cache, series_folder, series_uid, new_spacing=None):
+    # VolumeCache key of the intermediates of a series and the fingerprint of its DICOM files. Keyed on the
+    # names, sizes and mtimes of the DICOM files too, so that a changed series misses the cache.
+    fingerprint = fingerprint_folder(series_folder)
+    return cache.key(series_uid, dict(preprocessing_params(new_spacing), fingerprint=fingerprint)), fingerprint
+
+#--------------------------------------------------------------------------------------------------------------
+
+def load_intermediates(patient_folder, new_spacing=None, cache=None, names=('mask',)):
+    """
+    Returns the intermediates of compute_intermediates listed in names and their meta dictionary,
+    from the cache when one is given (computing and storing them first if needed). Cache entries
+    are keyed on the series UID, preprocessing_params and the fingerprint_folder of the series
+    (see intermediates_key).
+    """
+    patient_correct_folder = find_folder_with_max_files(patient_folder)
+    with stage('index_scan'):
+        patient = index_scan(patient_correct_folder)
+
+    if cache is None:
+        arrays, meta = compute_intermediates(patient, new_spacing, keep_hu='hu' in names)
+        return {name: arrays[name] for name in names}, meta
+
+    key, fingerprint = intermediates_key(cache, patient_correct_folder, patient[0]['series_uid'], new_spacing)
+    if not cache.has(key):
+        arrays, meta = compute_intermediates(patient, new_spacing, keep_hu=True)
+        meta['patient'] = os.path.basename(os.path.normpath(patient_folder))
+        meta['series_uid'] = patient[0]['series_uid']
+        meta['params'] = preprocessing_params(new_spacing)
+        meta['fingerprint'] = fingerprint
+        with stage('cache_save'):
+            cache.save(key, arrays, meta)
+        del arrays
+    with stage('cache_load'):
+        return cache.load(key, names)
+
+#--------------------------------------------------------------------------------------------------------------
+
+def process_patient(patient_folder, new_spacing=None, cache=None):
+    """
+    Returns the lung mask of the patient and the file names of its slices.
+
+    Parameters:
+    - cache: Optional VolumeCache. The HU volume, the normalized volume and the mask are stored
+      under the series UID, preprocessing_params and the fingerprint of the DICOM files, and reused
+      on the next run.
+    """
+    arrays, meta = load_intermediates(patient_folder, new_spacing, cache, ('mask',))
+    return arrays['mask'], meta['file_names']
+
+#--------------------------------------------------------------------------------------------------------------
 
-    # Normalize the pixel values to [0, 255]
-    pixel_array = (pixel_array - np.min(pixel_array)) / (np.max(pixel_array) - np.min(pixel_array)) * 255
+def to_jpg(pixel_array, value_range=None):
+    # Read the DICOM file
+    pixel_array = np.array(pixel_array, dtype=np.float32)
+
+    # Normalize the pixel values to [0, 255], over a fixed value_range (min, max) if given so
+    # that no scan of the slice is needed, over the slice's own min and max otherwise
+    if value_range is None:
+        value_range = (pixel_array.min(), pixel_array.max())
+    low, high = value_range
+    pixel_array -= low
+    pixel_array *= 255 / (high - low) if high > low else 0
+    np.clip(pixel_array, 0, 255, out=pixel_array)
     pixel_array = pixel_array.astype(np.uint8)
 
     # If the array has more than one channel, convert to grayscale
@@ -220,38 +654,366 @@ def to_jpg(pixel_array):
 
 #--------------------------------------------------------------------------------------------------------------
 
-INPUT_FOLDER = "/home/aiims/tumor/xml_parsing/LIDC-IDRI"
-OUTPUT_FOLDER = "/home/aiims/tumor/Preprocessed_CT_Scans" 
+def windows_to_jpg(channels):
+    # channels: one slice of multi_window, values in [0, 1], up to 3 windows
+    pixel_array = (channels * 255).astype(np.uint8)
+    if pixel_array.shape[-1] == 1:
+        return Image.fromarray(pixel_array[..., 0])
+    if pixel_array.shape[-1] == 2:
+        pixel_array = np.concatenate([pixel_array, np.zeros_like(pixel_array[..., :1])], axis=-1)
+    return Image.fromarray(pixel_array)  # (rows, columns, 3) uint8 is read as RGB
 
-# Ensure output directory exists
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-# Iterate through all patient directories
-patients = os.listdir(INPUT_FOLDER)
-patients.sort()
-preprocessed_scans=[]
-patient_names=[]
-
-for patient in patients:
-    patient_path = os.path.join(INPUT_FOLDER, patient)
-    if os.path.isdir(patient_path):  # Ensure it's a directory
-        patient_scans,scan_file=process_patient(patient_path)
-        combined_scans = [(patient_scans[i], scan_file[i]) for i in range(len(scan_file))]
-    preprocessed_scans.append(combined_scans)
-    patient_names.append(patient)
-
-for name, combined_scans in zip(patient_names, preprocessed_scans):
-    # Create a folder for each patient in the output directory
-    patient_folder = os.path.join(OUTPUT_FOLDER, name)
+#--------------------------------------------------------------------------------------------------------------
+
+def save_patient_jpgs(combined_scans, patient_folder, value_range=None, num_threads=None):
+    """
+    Saves every (scan, filename) slice as patient_folder/filename.jpg, encoding and writing them on a
+    SliceExportPool when num_threads (default export_threads()) > 1. value_range is passed to to_jpg.
+
+    Returns:
+    - saved: Names of the files written.
+    """
+    # Create a folder for the patient in the output directory
     os.makedirs(patient_folder, exist_ok=True)
-    
-    # Loop through combined scans to save each scan as a JPEG
-    for scan, filename in combined_scans:
-        img=to_jpg(scan)
+    saved = [f"{filename}.jpg" for _, filename in combined_scans]
 
-        # Construct the full file path for saving
-        file_name = os.path.join(patient_folder, f"{filename}.jpg")
+    num_threads = num_threads or export_threads()
+    if num_threads > 1:
+        with SliceExportPool(lambda scan: to_jpg(scan, value_range), num_threads) as pool:
+            for (scan, _), file_name in zip(combined_scans, saved):
+                pool.submit(os.path.join(patient_folder, file_name), scan)
+    else:
+        # Loop through combined scans to save each scan as a JPEG
+        for (scan, _), file_name in zip(combined_scans, saved):
+            to_jpg(scan, value_range).save(os.path.join(patient_folder, file_name))
+    return saved
+
+#--------------------------------------------------------------------------------------------------------------
 
-        # Save the image
-        img.save(file_name)
+def save_patient_window_jpgs(combined_scans, patient_folder, windows=EXPORT_WINDOWS, num_threads=None):
+    """
+    Saves every (HU slice, filename) as patient_folder/filename.jpg with up to three windows
+    (see multi_window) as its color channels, windowed slice by slice in the encoder threads. The
+    channels are not chroma-subsampled, every window keeps the full resolution.
 
-        print(f"Saved {file_name}")
+    Returns:
+    - saved: Names of the files written.
+    """
+    os.makedirs(patient_folder, exist_ok=True)
+    saved = [f"{filename}.jpg" for _, filename in combined_scans]
+    to_image = lambda scan: windows_to_jpg(multi_window(scan[None], windows)[0])
+    with SliceExportPool(to_image, num_threads or export_threads(), subsampling=0) as pool:
+        for (scan, _), file_name in zip(combined_scans, saved):
+            pool.submit(os.path.join(patient_folder, file_name), scan)
+    return saved
+
+#--------------------------------------------------------------------------------------------------------------
+
+def save_patient_pngs(combined_scans, patient_folder, window, num_threads=None):
+    """
+    Saves every (HU slice, filename) as a lossless 16-bit PNG patient_folder/filename.png, scaled with
+    the fixed window (see hu_to_uint16) and the fastest zlib level.
+
+    Returns:
+    - saved: Names of the files written.
+    """
+    os.makedirs(patient_folder, exist_ok=True)
+    saved = [f"{filename}.png" for _, filename in combined_scans]
+    to_png = lambda scan: Image.fromarray(hu_to_uint16(scan, window))  # uint16 is read as "I;16"
+    with SliceExportPool(to_png, num_threads or export_threads(), image_format='PNG', compress_level=1) as pool:
+        for (scan, _), file_name in zip(combined_scans, saved):
+            pool.submit(os.path.join(patient_folder, file_name), scan)
+    return saved
+
+#--------------------------------------------------------------------------------------------------------------
+
+def save_patient_shards(combined_scans, shard_folder, patient, value_range=None, labels=None,
+                        num_threads=None, max_queued=32):
+    """
+    Writes the slices of a patient as JPEG records into tar shards of shard_folder (see ShardWriter)
+    instead of one file per slice. Record keys are "<patient>_<filename>", the name the YOLO dataset
+    gives the images.
+
+    Parameters:
+    - labels: Optional dictionary filename -> JSON-serializable label stored with the record.
+    - max_queued: Maximum number of slices being encoded or waiting to be written, as in
+      SliceExportPool, so the encoded slices of a patient are never all held in memory.
+
+    Returns:
+    - saved: Names of the shard and index files written.
+    """
+    def encode(scan):
+        buffer = io.BytesIO()
+        to_jpg(scan, value_range).save(buffer, format='JPEG')
+        return buffer.getvalue()
+
+    labels = labels or {}
+    with ThreadPoolExecutor(max_workers=num_threads or export_threads()) as executor, \
+            ShardWriter(shard_folder, prefix=patient) as writer:
+        pending = deque()  # (filename, future) of the slices being encoded, in slice order
+
+        def write_pending(limit):
+            while len(pending) > limit:
+                filename, future = pending.popleft()
+                writer.write(f"{patient}_{filename}", future.result(), 'jpg', labels.get(filename),
+                             patient=patient, file_name=filename)
+
+        for scan, filename in combined_scans:
+            write_pending(max_queued - 1)
+            pending.append((filename, executor.submit(encode, scan)))
+        write_pending(0)
+    return writer.written
+
+#--------------------------------------------------------------------------------------------------------------
+
+def patient_slice_labels(patient_folder, meta, annotation_cache=None):
+    """
+    Labels of the slices of a patient (see yolo_labels.slice_labels), matched through the SOP-UIDs
+    of meta (from compute_intermediates). The annotations are read through annotation_cache if
+    given, from the XML file of the patient otherwise.
+
+    Returns:
+    - Dictionary file name -> label, empty if the patient has no annotation file.
+    """
+    patient = os.path.basename(os.path.normpath(patient_folder))
+    if annotation_cache is not None:
+        columns = load_patient(patient_folder, annotation_cache)
+    else:
+        xml_file = find_xml_file(find_folder_with_max_files(patient_folder))
+        columns = parse_columnar(xml_file) if xml_file else None
+    if columns is None:
+        return {}
+    table = NoduleTable({patient: columns})
+    return dict(zip(meta['file_names'], slice_labels(table, meta['sop_uids'])))
+
+#--------------------------------------------------------------------------------------------------------------
+
+def process_and_save_patient(patient_path, output_folder, new_spacing=None, cache_folder=None,
+                             export_format='jpg', num_threads=None):
+    """
+    Preprocesses (see process_patient) and writes the slices of one patient, so that only the
+    volume of the patient being processed is held in memory. cache_folder is the
+    root of an optional VolumeCache. export_format is one of:
+    - 'jpg': one JPEG of the lung mask per slice in output_folder/<patient>
+    - 'shards': the same JPEGs in tar shards in output_folder/shards, each record labelled by
+      patient_slice_labels (annotations read through ANNOTATION_CACHE)
+    - 'png16': one lossless 16-bit PNG of the HU values per slice in output_folder/<patient>,
+      scaled with the fixed EXPORT_HU_WINDOW (see hu_to_uint16)
+    - 'raw': the HU volume as memory-mappable output_folder/<patient>/volume.npy with
+      EXPORT_RAW_DTYPE (uint16 or float16), see save_raw_volume and load_raw_volume
+    - 'windows': one color JPEG per slice in output_folder/<patient> with the EXPORT_WINDOWS of the
+      HU values as channels (see save_patient_window_jpgs)
+    num_threads is the number of encoder threads of the export (default export_threads()).
+
+    Returns:
+    - (patient name, paths of the files written, relative to output_folder)
+    """
+    name = os.path.basename(os.path.normpath(patient_path))
+    cache = VolumeCache(cache_folder) if cache_folder else None
+    if export_format in ('png16', 'raw', 'windows'):
+        arrays, meta = load_intermediates(patient_path, new_spacing, cache, ('hu',))
+        patient_folder = os.path.join(output_folder, name)
+        with stage(f"export_{export_format}"):
+            if export_format == 'raw':
+                saved = save_raw_volume(patient_folder, arrays['hu'], meta['file_names'], EXPORT_HU_WINDOW,
+                                        EXPORT_RAW_DTYPE, spacing=meta['spacing'], z=meta['z'])
+            elif export_format == 'windows':
+                combined_scans = list(zip(arrays['hu'], meta['file_names']))
+                saved = save_patient_window_jpgs(combined_scans, patient_folder, EXPORT_WINDOWS, num_threads)
+            else:
+                combined_scans = list(zip(arrays['hu'], meta['file_names']))
+                saved = save_patient_pngs(combined_scans, patient_folder, EXPORT_HU_WINDOW, num_threads)
+        return name, [os.path.join(name, f) for f in saved]
+
+    arrays, meta = load_intermediates(patient_path, new_spacing, cache, ('mask',))
+    combined_scans = list(zip(arrays['mask'], meta['file_names']))
+    # The lung masks are 0/1, a fixed range avoids scanning every slice for its min and max
+    if export_format == 'shards':
+        with stage('slice_labels'):
+            labels = patient_slice_labels(patient_path, meta, ANNOTATION_CACHE)
+        with stage('export_shards'):
+            saved = save_patient_shards(combined_scans, os.path.join(output_folder, 'shards'), name,
+                                        value_range=(0, 1), labels=labels, num_threads=num_threads)
+        return name, [os.path.join('shards', f) for f in saved]
+    if export_format == 'jpg':
+        with stage('export_jpg'):
+            saved = save_patient_jpgs(combined_scans, os.path.join(output_folder, name), value_range=(0, 1),
+                                      num_threads=num_threads)
+        return name, [os.path.join(name, f) for f in saved]
+    raise ValueError(f"Unknown export format: {export_format}")
+
+#--------------------------------------------------------------------------------------------------------------
+
+def _process_and_save_instrumented(patient_path, *args):
+    # process_and_save_patient in a worker process, returning the stage records of the patient with its result
+    with collect(patient=os.path.basename(os.path.normpath(patient_path))) as stats:
+        name, saved = process_and_save_patient(patient_path, *args)
+    return name, saved, stats.records
+
+#--------------------------------------------------------------------------------------------------------------
+
+def patient_fingerprint(patient_path, export_format='jpg'):
+    """
+    Fingerprint of the inputs of a patient for the RunManifest: the DICOM files of its series and,
+    for LABELLED_FORMATS, its annotation XML file (the annotation cache is checked against the
+    XML file itself, see annotation_cache.load_patient).
+
+    Returns:
+    - Hex digest, None if the patient has no DICOM folder.
+    """
+    dicom_folder = find_folder_with_max_files(patient_path)
+    if not dicom_folder:
+        return None
+    fingerprint = fingerprint_folder(dicom_folder)
+    if export_format in LABELLED_FORMATS:
+        fingerprint = f"{fingerprint}:{fingerprint_file(find_xml_file(dicom_folder))}"
+    return fingerprint
+
+#--------------------------------------------------------------------------------------------------------------
+
+def run_patients(input_folder, output_folder, num_workers=None, max_in_flight=None, new_spacing=None,
+                 cache_folder=None, manifest_path=None, export_format='jpg', report_path=None):
+    """
+    Preprocesses every patient directory of input_folder into output_folder.
+
+    Parameters:
+    - num_workers: Number of worker processes (defaults to os.cpu_count()). 1 runs serially
+      in the current process. Each patient exports with export_threads(num_workers) threads.
+    - max_in_flight: Maximum number of patients submitted to the pool at once (defaults to
+      2 * num_workers). Workers return only the patient name and file names, so peak memory
+      is bounded by the volumes being processed by the workers.
+    - new_spacing: Optional (z, y, x) spacing in mm to resample every patient to, see process_patient.
+    - cache_folder: Optional root of a VolumeCache for the intermediate volumes, see process_patient.
+    - manifest_path: Optional RunManifest file. Patients whose inputs (see patient_fingerprint),
+      parameters and outputs are unchanged since their last successful run are skipped, the others
+      are recorded.
+    - export_format: 'jpg', 'shards', 'png16', 'raw' or 'windows', see process_and_save_patient.
+    - report_path: Optional JSON file for the report of the run: wall time, bytes read and written
+      and peak RSS per patient and stage (see instrumentation.RunStats). A summary table of the
+      stages is printed in any case.
+
+    Returns:
+    - results: List of (patient name, number of files written) for processed patients: one file
+      per slice for 'jpg', 'png16' and 'windows', the shard and index files for 'shards', the volume files
+      for 'raw'.
+    - failed: Dictionary mapping patient name to the error message.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    patients = sorted(os.listdir(input_folder))
+    patient_paths = [os.path.join(input_folder, p) for p in patients
+                     if os.path.isdir(os.path.join(input_folder, p))]
+
+    num_workers = num_workers or os.cpu_count() or 1
+    max_in_flight = max(max_in_flight or 2 * num_workers, num_workers)
+    results = []
+    failed = {}
+
+    manifest = RunManifest(manifest_path) if manifest_path else None
+    params = dict(preprocessing_params(new_spacing), output=export_format)
+    if export_format in ('png16', 'raw'):
+        params.update(hu_window=EXPORT_HU_WINDOW, raw_dtype=EXPORT_RAW_DTYPE)
+    elif export_format == 'windows':
+        params.update(windows=[CT_WINDOWS[w] if isinstance(w, str) else w for w in EXPORT_WINDOWS])
+    params = params_hash(params)
+    fingerprints = {}
+    if manifest is not None:
+        todo = []
+        for patient_path in patient_paths:
+            name = os.path.basename(patient_path)
+            fingerprints[name] = patient_fingerprint(patient_path, export_format)
+            if not manifest.is_up_to_date(name, fingerprints[name], params):
+                todo.append(patient_path)
+        print(f"Skipping {len(patient_paths) - len(todo)} up to date patients.")
+        patient_paths = todo
+
+    threads = export_threads(num_workers)  # Encoder threads per patient, so the workers share the CPUs
+    stats = RunStats()
+    progress = Progress("Preprocessed patients", len(patient_paths))
+
+    def on_done(patient_path, saved):
+        name = os.path.basename(patient_path)
+        results.append((name, len(saved)))
+        if manifest is not None:
+            manifest.record(name, fingerprints[name], params, 'done', output_folder, saved)
+        progress.update(item=name)
+
+    def on_error(patient_path, e):
+        name = os.path.basename(patient_path)
+        failed[name] = str(e)
+        print(f"Error processing {patient_path}: {e}")
+        if manifest is not None:
+            manifest.record(name, fingerprints[name], params, 'failed', error=str(e))
+        progress.update(item=name)
+
+    if num_workers == 1:
+        for patient_path in patient_paths:
+            try:
+                with collect(stats, patient=os.path.basename(patient_path)):
+                    _, saved = process_and_save_patient(patient_path, output_folder, new_spacing, cache_folder,
+                                                        export_format, threads)
+            except Exception as e:
+                on_error(patient_path, e)
+                continue
+            on_done(patient_path, saved)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            pending = {}
+            queue = iter(patient_paths)
+            exhausted = False
+            while pending or not exhausted:
+                # Keep at most max_in_flight patients submitted to the pool
+                while not exhausted and len(pending) < max_in_flight:
+                    patient_path = next(queue, None)
+                    if patient_path is None:
+                        exhausted = True
+                        break
+                    future = executor.submit(_process_and_save_instrumented, patient_path, output_folder,
+                                             new_spacing, cache_folder, export_format, threads)
+                    pending[future] = patient_path
+
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    patient_path = pending.pop(future)
+                    try:
+                        _, saved, records = future.result()
+                    except Exception as e:
+                        on_error(patient_path, e)
+                        continue
+                    stats.extend(records)
+                    on_done(patient_path, saved)
+
+    progress.close()
+    if stats.records:
+        print(stats.summary_table())
+    if report_path is not None:
+        stats.report(report_path, input_folder=input_folder, export_format=export_format, workers=num_workers,
+                     processed=len(results), failed=failed)
+    results.sort()
+    return results, failed
+
+#--------------------------------------------------------------------------------------------------------------
+
+INPUT_FOLDER = "/home/aiims/tumor/xml_parsing/LIDC-IDRI"
+OUTPUT_FOLDER = "/home/aiims/tumor/Preprocessed_CT_Scans" 
+NUM_WORKERS = os.cpu_count() or 1  # Set to 1 to process the patients serially
+MAX_IN_FLIGHT = 2 * NUM_WORKERS  # Patients submitted to the pool at once
+# Isotropic resampling in mm, None to keep the spacing of the scans. Resampled JPEGs are named
+# "<DICOM file name>_r<index>" after their nearest DICOM slice, which the YOLO and CNN label matching maps back.
+RESAMPLE_SPACING = [1, 1, 1]
+# Root of the VolumeCache of HU volumes, normalized volumes and lung masks, None to disable caching
+CACHE_FOLDER = None
+# Run manifest used to skip patients that are already up to date on reruns
+MANIFEST_PATH = os.path.join(OUTPUT_FOLDER, "run_manifest.jsonl")
+# 'jpg' for one JPEG per slice, 'shards' for tar shards with an index (see shard_dataset.py),
+# 'png16' or 'raw' for 16-bit HU slices, 'windows' for color JPEGs of the lung, mediastinal and bone windows
+# (see process_and_save_patient)
+EXPORT_FORMAT = 'jpg'
+# Per-patient, per-stage timing and I/O report of the run, None to only print the summary
+REPORT_PATH = os.path.join(OUTPUT_FOLDER, "run_report.json")
+
+if __name__ == "__main__":
+    results, failed = run_patients(INPUT_FOLDER, OUTPUT_FOLDER, NUM_WORKERS, MAX_IN_FLIGHT, RESAMPLE_SPACING,
+                                   CACHE_FOLDER, MANIFEST_PATH, EXPORT_FORMAT, REPORT_PATH)
+    print(f"Preprocessed {len(results)} patients, {len(failed)} failed.")
@@ -0,0 +1,133 @@
+import errno
+import fcntl
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# Assembly of the YOLO and CNN dataset folders from the preprocessed slices without duplicating them:
+# stage_files creates hard links (or reflinks on copy-on-write file systems such as btrfs and XFS) and copies
+# only when neither is possible, e.g. across file systems. reconcile_folders keeps an image folder and a label
+# folder in step with one directory scan per folder.
+
+FICLONE = 0x40049409  # Linux ioctl cloning a whole file (reflink)
+STAGE_MODES = ('link', 'hardlink', 'reflink', 'symlink', 'copy')
+
+#--------------------------------------------------------------------------------------------------------------
+
+def _reflink(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+#--------------------------------------------------------------------------------------------------------------
+
+def stage_file(src, dst, mode='link'):
+    """
+    Makes dst refer to the content of src. mode 'link' tries a hard link, then a reflink, then
+    copies; 'hardlink', 'reflink', 'symlink' and 'copy' use only that method. An existing dst is
+    replaced.
+
+    Returns:
+    - Method used: 'hardlink', 'reflink', 'symlink' or 'copy'.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode in ('link', 'hardlink'):
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if mode == 'hardlink' or e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    if mode in ('link', 'reflink'):
+        try:
+            _reflink(src, dst)
+            return 'reflink'
+        except OSError:
+            if mode == 'reflink':
+                raise
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return 'symlink'
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+#--------------------------------------------------------------------------------------------------------------
+
+def stage_files(pairs, mode='link', num_threads=8, batch_size=512):
+    """
+    Stages (src, dst) pairs with stage_file, in batches on num_threads threads. The destination
+    folders are created first.
+
+    Returns:
+    - Dictionary method -> number of files staged with it.
+    """
+    pairs = list(pairs)
+    for folder in {os.path.dirname(dst) for _, dst in pairs}:
+        os.makedirs(folder or '.', exist_ok=True)
+
+    def stage_batch(batch):
+        counts = {}
+        for src, dst in batch:
+            method = stage_file(src, dst, mode)
+            counts[method] = counts.get(method, 0) + 1
+        return counts
+
+    batches = [pairs[i:i + batch_size] for i in range(0, len(pairs), batch_size)]
+    totals = {}
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for counts in executor.map(stage_batch, batches):
+            for method, n in counts.items():
+                totals[method] = totals.get(method, 0) + n
+    return totals
+
+#--------------------------------------------------------------------------------------------------------------
+
+def _stems(folder):
+    # Dictionary file name without extension -> file names, from a single scan of folder
+    stems = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stems.setdefault(os.path.splitext(entry.name)[0], []).append(entry.name)
+    return stems
+
+#--------------------------------------------------------------------------------------------------------------
+
+def reconcile_folders(folder_1, folder_2, dry_run=False, quarantine=None):
+    """
+    Removes the files of folder_1 whose name without extension has no file in folder_2, and
+    the other way round (e.g. images without labels and labels without images).
+
+    Parameters:
+    - dry_run: Only report the orphans.
+    - quarantine: Folder the orphans are moved to (into a sub-folder named after their folder)
+      instead of being deleted.
+
+    Returns:
+    - Dictionary folder -> sorted names of its orphan files.
+    """
+    stems_1, stems_2 = _stems(folder_1), _stems(folder_2)
+    report = {}
+    for folder, stems, other in ((folder_1, stems_1, stems_2), (folder_2, stems_2, stems_1)):
+        orphans = sorted(name for stem in stems.keys() - other.keys() for name in stems[stem])
+        report[folder] = orphans
+        if dry_run or not orphans:
+            continue
+        if quarantine is not None:
+            target = os.path.join(quarantine, os.path.basename(os.path.normpath(folder)))
+            os.makedirs(target, exist_ok=True)
+        for name in orphans:
+            path = os.path.join(folder, name)
+            if quarantine is None:
+                os.remove(path)
+            else:
+                shutil.move(path, os.path.join(target, name))
+    action = "would be removed" if dry_run else ("moved to " + quarantine if quarantine else "removed")
+    for folder, orphans in report.items():
+        print(f"{len(orphans)} files of {folder} without a counterpart {action}")
+    return report
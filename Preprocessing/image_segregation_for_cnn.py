@@ -1,103 +1,112 @@
-import pydicom
-from PIL import Image
+import argparse
 import os
-import glob
-import shutil
-import pandas as pd
 import numpy as np
-from all_annotations_main import run_annotations
-from utils import create_folder, find_folder_with_max_files
-import re
-
-def cancer_nodes_zpos(folder_path):
-    data_dict = run_annotations(folder_path)
-    # print(data_dict.keys())
-    # print(data_dict.items())
+from nodule_table import NoduleTable
+from utils import create_folder
+from sop_index import build_index
+from dataset_staging import stage_files
+from slice_export import source_slice_name
+
+# Splits the preprocessed slice images into cancerous (slices with a normal nodule ROI) and non-cancerous
+# folders for the CNN. Output names are "<patient>_<file name>", so reruns and parallel runs on different
+# patients never collide.
+# Usage: python image_segregation_for_cnn.py [--dataset DIR] [--input DIR] [--output DIR] ...
+
+DATASET_FOLDER = "/home/aiims/tumor/xml_parsing/LIDC-IDRI"
+INPUT_FOLDER = "/home/aiims/tumor/Preprocessed_CT_Scans"
+OUTPUT_FOLDER = "/home/aiims/tumor/xml_parsing/sanidhya"
+ANNOTATION_CACHE = "/home/aiims/tumor/xml_parsing/annotation_cache"
+SOP_INDEX_PATH = "/home/aiims/tumor/xml_parsing/sop_index.sqlite"
+BATCH_SIZE = 10000  # Slices staged per stage_files call
+
+#--------------------------------------------------------------------------------------------------------------
+
+def cancer_nodes_zpos(folder_path, cache_dir=ANNOTATION_CACHE):
+    # One dataset-wide table instead of filtering every patient's DataFrame
+    table = NoduleTable.load(folder_path, cache_dir, num_workers=os.cpu_count())
+    rows = table.select(nodule_type='N')  # Rows are ordered by patient
+    bounds = np.searchsorted(table.patient.codes[rows], np.arange(len(table.patients()) + 1))
     new_dict = {}
-    for key in data_dict.keys():
-        df, char = data_dict[key]
-        field = "Nodule Type"
-        filtered_df = df[df[field] == 'N']
-        # print(filtered_df.head()) if key == "LIDC-IDRI-0203" else None
-        # Extract each column from the filtered rows into separate lists
-        value1_list = filtered_df['Z-Coordinate'].tolist()
-        value2_list = filtered_df['SOP-UID'].tolist()
-        new_dict[key] = (value1_list, value2_list)
-    # print(new_dict["LIDC-IDRI-0203"][0])
+    for i, key in enumerate(table.patients()):
+        patient_rows = rows[bounds[i]:bounds[i + 1]]
+        new_dict[key] = (table.columns['z'][patient_rows].tolist(), table.columns['sop_uid'][patient_rows].tolist())
     return new_dict
 
-def Cancerous_slices():
+#--------------------------------------------------------------------------------------------------------------
+
+def Cancerous_slices(dirname=DATASET_FOLDER, sop_index_path=SOP_INDEX_PATH, cache_dir=ANNOTATION_CACHE):
+    """
+    Gives the cancerous slices of all the patients of dirname.
+
+    Returns:
+    - Set of "<patient>/<DICOM file name without .dcm>" keys.
+    """
+    node_dict = cancer_nodes_zpos(dirname, cache_dir)
+    cancerous = set()
+    # SOP-UID -> file lookups go through the persistent index instead of reading every DICOM
+    with build_index(dirname, sop_index_path) as sop_index:
+        for patient, (_, sopuid_list) in node_dict.items():
+            for path in sop_index.lookup_many(sopuid_list).values():
+                cancerous.add(f"{patient}/{os.path.splitext(os.path.basename(path))[0]}")
+    return cancerous
+
+#--------------------------------------------------------------------------------------------------------------
+
+def iter_slices(input_folder):
+    # Streams (patient, file name, path) of the files of every patient folder, without listing them first
+    with os.scandir(input_folder) as patients:
+        for patient in patients:
+            if not patient.is_dir():
+                continue
+            with os.scandir(patient.path) as files:
+                for entry in files:
+                    if entry.is_file():
+                        yield patient.name, entry.name, entry.path
+
+#--------------------------------------------------------------------------------------------------------------
+
+def segregate_slices(input_folder, output_folder, cancerous, mode='link', num_threads=8):
     """
-    Gives a list of cancerous slices from all the files
+    Stages every slice image of input_folder into output_folder/cancerous_jpg if its
+    "<patient>/<name without .jpg>" key (the name of the nearest DICOM slice for resampled slices,
+    see slice_export.source_slice_name) is in cancerous, into output_folder/non_cancerous_jpg
+    otherwise, as "<patient>_<file name>" (see dataset_staging.stage_files for mode).
+
+    Returns:
+    - Dictionary folder name -> number of slices.
     """
-    # Ensure output directories exist
-    dirname = "/home/aiims/tumor/xml_parsing/LIDC-IDRI"
-    node_dict = cancer_nodes_zpos(dirname)
-    patient_folder_list = node_dict.keys()
-    list_of_cancerous_slices=[]
-    for patient_folder_name in patient_folder_list:
-        patient_folder = os.path.join(dirname, patient_folder_name)    
-        dicom_folder = find_folder_with_max_files(patient_folder)
-        sopuid_list = node_dict[patient_folder_name][1]
-        for file_path in glob.glob(os.path.join(dicom_folder, "*.dcm")):
-            dicom_file = pydicom.dcmread(file_path)
-
-            # Get the SOPInstanceUID for the current file
-            sop_uid = dicom_file.SOPInstanceUID if 'SOPInstanceUID' in dicom_file else None
-
-            # Determine if this file matches one of the target SOPInstanceUIDs
-            if sop_uid in sopuid_list:
-                list_of_cancerous_slices.append(file_path)
-    return list_of_cancerous_slices
-    
-# Regular expression to capture LIDC-IDRI-XXXX and X-XXX
-pattern = r'LIDC-IDRI-(\d{4})\/.*?\/(\d+-\d+)(?=\.dcm)'
-list_of_slices=Cancerous_slices()
-
-# Extracting the required parts
-results = []
-for path in list_of_slices:
-    match = re.search(pattern, path)
-    if match:
-        lidc_idri = f"LIDC-IDRI-{match.group(1)}"
-        x_xxx = match.group(2)
-        new_path = os.path.join(lidc_idri, x_xxx)  
-        results.append((lidc_idri, x_xxx, new_path))
-        
-results.sort(key=lambda x: x[0])
-
-INPUT_FOLDER = "/home/aiims/tumor/Preprocessed_CT_Scans" 
-
-expected_files = [os.path.join(INPUT_FOLDER, f"{new_path}.jpg") for _, _, new_path in results]
-patients = os.listdir(INPUT_FOLDER)
-patients.sort()
-preprocessed_scans=[]
-patient_names=[]
-
-create_folder("/home/aiims/tumor/xml_parsing/sanidhya", "cancerous_jpg")
-create_folder("/home/aiims/tumor/xml_parsing/sanidhya", "non_cancerous_jpg") 
-a=1
-b=1
-for patient in patients:
-    patient_path = os.path.join(INPUT_FOLDER, patient)
-    if os.path.isdir(patient_path):  # Ensure it's a directory
-        for file_name in os.listdir(patient_path):
-            # Create the full file path
-            
-            file_path = os.path.join(patient_path, file_name) 
-            if file_path in expected_files:
-                    # Create the destination path in the output folder
-                output_folder = "/home/aiims/tumor/xml_parsing/sanidhya/cancerous_jpg"
-                output_path = os.path.join(output_folder,f"{a}.jpg")
-                a+=1
-                shutil.copy(file_path, output_path)
-                
-            else:
-                output_folder = "/home/aiims/tumor/xml_parsing/sanidhya/non_cancerous_jpg"
-                output_path = os.path.join(output_folder, f"{b}.jpg")
-                b+=1
-                shutil.copy(file_path, output_path)
-                
-        print("DICOM files have been organized into matching and non-matching folders.")
-       
+    folders = {True: create_folder(output_folder, "cancerous_jpg"),
+               False: create_folder(output_folder, "non_cancerous_jpg")}
+    counts = {os.path.basename(folder): 0 for folder in folders.values()}
+    batch = []
+    for patient, file_name, path in iter_slices(input_folder):
+        stem, ext = os.path.splitext(file_name)
+        is_cancerous = ext == '.jpg' and f"{patient}/{source_slice_name(stem)}" in cancerous
+        batch.append((path, os.path.join(folders[is_cancerous], f"{patient}_{file_name}")))
+        counts[os.path.basename(folders[is_cancerous])] += 1
+        if len(batch) >= BATCH_SIZE:
+            stage_files(batch, mode, num_threads)
+            batch = []
+    stage_files(batch, mode, num_threads)
+    return counts
+
+#--------------------------------------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split preprocessed slices into cancerous and non-cancerous folders.")
+    parser.add_argument('--dataset', default=DATASET_FOLDER, help="LIDC-IDRI folder with the DICOM and XML files")
+    parser.add_argument('--input', default=INPUT_FOLDER, help="Preprocessed slices, one folder per patient")
+    parser.add_argument('--output', default=OUTPUT_FOLDER)
+    parser.add_argument('--sop-index', default=SOP_INDEX_PATH)
+    parser.add_argument('--annotation-cache', default=ANNOTATION_CACHE)
+    parser.add_argument('--mode', default='link', choices=['link', 'hardlink', 'reflink', 'symlink', 'copy'])
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    cancerous = Cancerous_slices(args.dataset, args.sop_index, args.annotation_cache)
+    counts = segregate_slices(args.input, args.output, cancerous, args.mode, args.threads)
+    print(f"DICOM files have been organized into matching and non-matching folders: {counts}")
+    return counts
 
+if __name__ == "__main__":
+    main()
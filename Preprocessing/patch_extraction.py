@@ -0,0 +1,150 @@
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+from Preprocessing_steps import load_intermediates, find_folder_with_max_files
+from volume_cache import VolumeCache
+from nodule_table import NoduleTable
+from consensus import cluster_rois
+
+# 3D training patches for the CNN: cubes of size^3 voxels of the (resampled) HU volume around every nodule,
+# plus cubes around random lung voxels away from all nodules as negatives. The volumes are opened
+# memory-mapped from the VolumeCache and the cubes of a patient are cut with one fancy-indexing gather, so only
+# the pages under the patches are read.
+
+PATCH_SIZE = 32  # Voxels per side
+PATCH_FILL = -1024  # HU of the voxels of a patch outside the volume (air)
+
+#--------------------------------------------------------------------------------------------------------------
+
+def voxel_coordinates(z, y, x, meta, shape):
+    """
+    Maps slice positions z (mm) and pixel coordinates y (row), x (column) of the DICOM series to
+    (n, 3) voxel coordinates of the volume of compute_intermediates, resampled or not.
+    """
+    source_z = np.asarray(meta.get('source_z', meta['z']), dtype=np.float64)
+    source_shape = np.asarray(meta.get('source_shape', shape), dtype=np.float64)
+    coords = np.stack([np.interp(z, source_z, np.arange(len(source_z))), y, x], axis=1).astype(np.float64)
+    # resample_volume maps input coordinate i to i * (n_out - 1) / (n_in - 1)
+    scale = np.where(source_shape > 1, (np.asarray(shape) - 1) / np.maximum(source_shape - 1, 1), 1.)
+    return coords * scale
+
+#--------------------------------------------------------------------------------------------------------------
+
+def nodule_centers(table, patient, meta, shape, max_distance=10.):
+    """
+    Voxel centers of the nodules of a patient: the ROIs of normal nodules are merged across
+    radiologists and slices with consensus.cluster_rois and every 3D cluster gives one center
+    (mean of its ROI centers).
+
+    Returns:
+    - (centers (n, 3), mean malignancy (n,), number of ROIs (n,))
+    """
+    rows = table.select(nodule_type='N', patients=patient, inclusion=True)
+    if len(rows) == 0:
+        return np.zeros((0, 3)), np.zeros(0), np.zeros(0, dtype=np.int64)
+    rows, _, nodule = cluster_rois(table, rows, max_distance)
+    c = table.columns
+    coords = voxel_coordinates(c['z'][rows], c['cy'][rows], c['cx'][rows], meta, shape)
+    _, nodule = np.unique(nodule, return_inverse=True)
+    n_rois = np.bincount(nodule)
+    centers = np.stack([np.bincount(nodule, coords[:, i]) for i in range(3)], axis=1) / n_rois[:, None]
+    malignancy = np.bincount(nodule, c['malig'][rows].astype(np.float64)) / n_rois
+    return centers, malignancy, n_rois
+
+#--------------------------------------------------------------------------------------------------------------
+
+def extract_patches(volume, centers, size=PATCH_SIZE, fill=PATCH_FILL):
+    """
+    Cuts a size^3 cube around every center (voxel coordinates, rounded) out of volume, which can
+    be a memory-mapped array. Voxels outside the volume are set to fill.
+
+    Returns:
+    - Array (n, size, size, size) of the dtype of volume.
+    """
+    centers = np.rint(np.asarray(centers, dtype=np.float64)).astype(np.int64).reshape(-1, 3)
+    offsets = np.arange(size) - size // 2
+    index = [centers[:, axis, None] + offsets for axis in range(3)]  # (n, size) per axis
+    inside = [(i >= 0) & (i < n) for i, n in zip(index, volume.shape)]
+    index = [np.clip(i, 0, n - 1) for i, n in zip(index, volume.shape)]
+    patches = volume[index[0][:, :, None, None], index[1][:, None, :, None], index[2][:, None, None, :]]
+    outside = ~(inside[0][:, :, None, None] & inside[1][:, None, :, None] & inside[2][:, None, None, :])
+    patches[outside] = fill
+    return patches
+
+#--------------------------------------------------------------------------------------------------------------
+
+def sample_negatives(mask, centers, n, min_distance=PATCH_SIZE, rng=None, max_rounds=20):
+    """
+    Draws up to n random voxels inside the lung mask farther than min_distance voxels from every
+    center. Candidates are drawn and tested in vectorized rounds.
+
+    Returns:
+    - (m, 3) array of voxel coordinates, m <= n.
+    """
+    rng = np.random.default_rng(rng)
+    tree = cKDTree(centers) if len(centers) else None
+    shape = np.array(mask.shape)
+    found = []
+    n_found = 0
+    for _ in range(max_rounds):
+        if n_found >= n:
+            break
+        candidates = (rng.random((4 * n, 3)) * shape).astype(np.int64)
+        keep = mask[candidates[:, 0], candidates[:, 1], candidates[:, 2]].astype(bool)
+        if tree is not None:
+            keep &= tree.query(candidates, distance_upper_bound=min_distance)[0] == np.inf
+        found.append(candidates[keep])
+        n_found += int(keep.sum())
+    found = np.concatenate(found) if found else np.zeros((0, 3), dtype=np.int64)
+    return found[:n]
+
+#--------------------------------------------------------------------------------------------------------------
+
+def extract_patient_patches(patient_folder, table, cache, new_spacing=(1, 1, 1), size=PATCH_SIZE,
+                            negatives_per_nodule=2, min_negatives=4, rng=None):
+    """
+    Extracts the nodule and negative patches of one patient from the cached HU volume (computed
+    and cached by load_intermediates if needed).
+
+    Returns:
+    - Dictionary with 'patches' (n, size, size, size), 'labels' (1 nodule, 0 negative),
+      'malignancy' (mean rating, 0 for negatives) and 'centers' (voxel coordinates).
+    """
+    patient = os.path.basename(os.path.normpath(patient_folder))
+    arrays, meta = load_intermediates(patient_folder, new_spacing, cache, ('hu', 'mask'))
+    volume, mask = arrays['hu'], arrays['mask']
+    centers, malignancy, _ = nodule_centers(table, patient, meta, volume.shape)
+    n_negatives = max(negatives_per_nodule * len(centers), min_negatives)
+    negatives = sample_negatives(mask, centers, n_negatives, min_distance=size, rng=rng)
+    all_centers = np.concatenate([centers, negatives]).astype(np.float64)
+    return {
+        'patches': extract_patches(volume, all_centers, size),
+        'labels': np.r_[np.ones(len(centers), dtype=np.int8), np.zeros(len(negatives), dtype=np.int8)],
+        'malignancy': np.r_[malignancy, np.zeros(len(negatives))].astype(np.float32),
+        'centers': all_centers.astype(np.float32),
+    }
+
+#--------------------------------------------------------------------------------------------------------------
+
+INPUT_FOLDER = "/home/aiims/tumor/xml_parsing/LIDC-IDRI"
+OUTPUT_FOLDER = "/home/aiims/tumor/nodule_patches"
+CACHE_FOLDER = "/home/aiims/tumor/volume_cache"  # Resampled HU volumes and masks, reused across runs
+ANNOTATION_CACHE = "/home/aiims/tumor/annotation_cache"
+PATCH_SPACING = (1, 1, 1)  # Isotropic voxels, so that a patch covers the same size in every direction
+
+if __name__ == "__main__":
+    table = NoduleTable.load(INPUT_FOLDER, ANNOTATION_CACHE, num_workers=os.cpu_count())
+    cache = VolumeCache(CACHE_FOLDER)
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for patient in table.patients():
+        patient_folder = os.path.join(INPUT_FOLDER, patient)
+        if find_folder_with_max_files(patient_folder) is None:
+            continue
+        try:
+            result = extract_patient_patches(patient_folder, table, cache, PATCH_SPACING, rng=rng)
+        except Exception as e:
+            print(f"Error extracting patches of {patient}: {e}")
+            continue
+        np.savez(os.path.join(OUTPUT_FOLDER, f"{patient}.npz"), **result)
+        print(f"{patient}: {int(result['labels'].sum())} nodule and {int((result['labels'] == 0).sum())} negative patches")
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import time
+
+# Per-patient manifest of a preprocessing run, so that reruns only process new, changed or failed patients.
+# The manifest is a JSON-lines file with one record per processed patient, appended as soon as the patient
+# is done; the last record of a patient wins when the file is loaded.
+
+#--------------------------------------------------------------------------------------------------------------
+
+def fingerprint_folder(folder, suffix='.dcm'):
+    # Hash of the names, sizes and modification times of the files of folder ending with suffix
+    h = hashlib.sha1()
+    entries = sorted((e for e in os.scandir(folder) if e.is_file() and e.name.endswith(suffix)),
+                     key=lambda e: e.name)
+    for entry in entries:
+        st = entry.stat()
+        h.update(f"{entry.name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+#--------------------------------------------------------------------------------------------------------------
+
+def fingerprint_file(path):
+    # Hash of the path, size and modification time of one file, None if there is no such file
+    if not path or not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode()).hexdigest()
+
+#--------------------------------------------------------------------------------------------------------------
+
+class RunManifest:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Last line of a run that crashed while writing
+                    self.entries[record['patient']] = record
+
+    def is_up_to_date(self, patient, fingerprint, params):
+        """
+        True if the last run of patient succeeded with the same input fingerprint and parameters
+        and all of its outputs still exist.
+        """
+        record = self.entries.get(patient)
+        if record is None or record['status'] != 'done':
+            return False
+        if record['fingerprint'] != fingerprint or record['params'] != params:
+            return False
+        output_folder = record['output_folder']
+        return all(os.path.exists(os.path.join(output_folder, f)) for f in record['outputs'])
+
+    def record(self, patient, fingerprint, params, status, output_folder=None, outputs=(), error=None):
+        """
+        Appends the result of a patient. outputs are file names relative to output_folder.
+        status is 'done' or 'failed'.
+        """
+        record = {
+            'patient': patient,
+            'status': status,
+            'fingerprint': fingerprint,
+            'params': params,
+            'output_folder': output_folder,
+            'outputs': list(outputs),
+            'error': error,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self.entries[patient] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+        return record
+
+    def compact(self):
+        # Rewrites the manifest with only the last record of every patient
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for patient in sorted(self.entries):
+                f.write(json.dumps(self.entries[patient]) + "\n")
+        os.replace(tmp, self.path)
+
+    def summary(self):
+        # Number of patients per status
+        counts = {}
+        for record in self.entries.values():
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+        return counts
@@ -0,0 +1,148 @@
+import io
+import json
+import os
+import re
+import tarfile
+import time
+from PIL import Image
+
+# Packed slice dataset: slices (encoded images or arrays) and their labels are written into tar shards, so a
+# patient produces a couple of files instead of one file per slice. Every shard <name>.tar has an index
+# <name>.idx.json with the key, label, byte offset and size of each record, so a loader can read the shards
+# sequentially or jump to any record with a single seek. The shards are plain tar files and can be inspected
+# or unpacked with tar.
+
+#--------------------------------------------------------------------------------------------------------------
+
+class ShardWriter:
+    def __init__(self, folder, prefix='shard', max_records=10000, max_bytes=1 << 30):
+        """
+        Writes <folder>/<prefix>-000000.tar, <prefix>-000001.tar, ... starting a new shard after
+        max_records records or max_bytes bytes. Writers running in parallel need different prefixes.
+        The shards replace those of a previous writer with the same prefix: close() removes the
+        ones beyond the last shard written, so readers never pick up stale records.
+        """
+        self.folder = folder
+        self.prefix = prefix
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.shard_number = 0
+        self.tar = None
+        self.records = []
+        self.size = 0
+        self.written = []  # Names of the closed shard and index files
+        os.makedirs(folder, exist_ok=True)
+
+    def _open(self):
+        self.name = f"{self.prefix}-{self.shard_number:06d}"
+        self.tar = tarfile.open(os.path.join(self.folder, f"{self.name}.tar"), 'w')
+        self.records = []
+        self.size = 0
+
+    def _close_shard(self):
+        self.tar.close()
+        index_name = f"{self.name}.idx.json"
+        with open(os.path.join(self.folder, index_name), 'w') as f:
+            json.dump({'shard': f"{self.name}.tar", 'records': self.records}, f)
+        self.written += [f"{self.name}.tar", index_name]
+        self.tar = None
+        self.shard_number += 1
+
+    def write(self, key, data, ext='jpg', label=None, **meta):
+        """
+        Adds one record. data are the encoded bytes stored as the member <key>.<ext>; label and
+        meta must be JSON-serializable and are stored in the index.
+        """
+        if self.tar is None:
+            self._open()
+        info = tarfile.TarInfo(f"{key}.{ext}")
+        info.size = len(data)
+        info.mtime = time.time()
+        # The data follows the header block(s) of the member
+        offset = self.tar.offset + len(info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        self.tar.addfile(info, io.BytesIO(data))
+        self.records.append(dict(meta, key=key, ext=ext, label=label, offset=offset, size=len(data)))
+        self.size += len(data)
+        if len(self.records) >= self.max_records or self.size >= self.max_bytes:
+            self._close_shard()
+
+    def close(self):
+        # Returns the names of the shard and index files written
+        if self.tar is not None:
+            self._close_shard()
+        self._remove_stale()
+        return self.written
+
+    def _remove_stale(self):
+        # Removes the shards of the prefix left by an earlier, longer run, the index (read first by ShardReader) first
+        pattern = re.compile(re.escape(self.prefix) + r'-(\d{6})\.(idx\.json|tar)$')
+        stale = [(m.group(2) == 'tar', name) for name in os.listdir(self.folder)
+                 for m in [pattern.match(name)] if m and int(m.group(1)) >= self.shard_number]
+        for _, name in sorted(stale):
+            os.remove(os.path.join(self.folder, name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#--------------------------------------------------------------------------------------------------------------
+
+class ShardReader:
+    def __init__(self, folder):
+        """
+        Opens every shard index of folder. Records are numbered in shard name order and within a
+        shard in the order they were written.
+        """
+        self.folder = folder
+        self.records = []
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith('.idx.json'):
+                continue
+            with open(os.path.join(folder, name)) as f:
+                index = json.load(f)
+            for record in index['records']:
+                record['shard'] = index['shard']
+                self.records.append(record)
+        self._files = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def _file(self, shard):
+        if shard not in self._files:
+            self._files[shard] = open(os.path.join(self.folder, shard), 'rb')
+        return self._files[shard]
+
+    def __getitem__(self, i):
+        # Random access to record i: (record, bytes)
+        record = self.records[i]
+        f = self._file(record['shard'])
+        f.seek(record['offset'])
+        return record, f.read(record['size'])
+
+    def __iter__(self):
+        # Sequential read, one shard file open at a time
+        shard, f = None, None
+        for record in self.records:
+            if record['shard'] != shard:
+                if f is not None:
+                    f.close()
+                shard = record['shard']
+                f = open(os.path.join(self.folder, shard), 'rb')
+            f.seek(record['offset'])
+            yield record, f.read(record['size'])
+        if f is not None:
+            f.close()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+#--------------------------------------------------------------------------------------------------------------
+
+def decode_image(data):
+    # Decodes the bytes of an image record
+    return Image.open(io.BytesIO(data))
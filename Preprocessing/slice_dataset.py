@@ -0,0 +1,181 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from Preprocessing_steps import (find_folder_with_max_files, index_scan, load_intermediates, scan_spacing,
+                                 resampled_shape, intermediates_key)
+from slice_export import resampled_slice_names, source_slice_name
+
+# Lazy (slice, label) dataset served straight from the DICOM series (or from a VolumeCache) instead of the
+# exported JPEGs. A patient's volumes are computed by load_intermediates (HU conversion, lung window,
+# smoothing and lung segmentation) the first time one of its slices is requested. They are then kept in an LRU
+# cache bounded by memory_limit bytes, and the next patients are prepared on background threads in the
+# meantime. Patients being loaded count towards the limit with the size estimated from their headers (the
+# volumes computed on a cache miss included).
+
+#--------------------------------------------------------------------------------------------------------------
+
+def _nbytes(arrays):
+    # Memory held by a patient's arrays; memory-mapped cache entries live in the page cache and count as 0
+    return sum(a.nbytes for a in arrays.values() if not isinstance(a, np.memmap))
+
+#--------------------------------------------------------------------------------------------------------------
+
+class SliceDataset:
+    def __init__(self, patient_folders, labels=None, names=('normalized',), cache=None, new_spacing=None,
+                 memory_limit=2 << 30, prefetch=2, num_threads=2):
+        """
+        Parameters:
+        - patient_folders: Patient folders (as in the LIDC-IDRI tree) in sample order.
+        - labels: Set of "<patient>/<slice name>" keys labelled 1 (e.g. Cancerous_slices()), a
+          dictionary key -> label, a function (patient, slice name) -> label, or None (label -1).
+          Slice names are the DICOM file names without .dcm; resampled slices are labelled like their
+          nearest DICOM slice (see slice_export.source_slice_name).
+        - names: Volumes of compute_intermediates served per sample ('normalized', 'mask', 'hu');
+          several names are stacked on a first channel axis.
+        - cache: Optional VolumeCache, the volumes are then computed once and memory-mapped.
+        - memory_limit: Bytes of decoded volumes kept in memory, including the patients being loaded.
+        - prefetch: Number of upcoming patients prepared in the background, as far as memory_limit
+          allows.
+        """
+        self.names = tuple(names)
+        self.cache = cache
+        self.new_spacing = new_spacing
+        self.memory_limit = memory_limit
+        self.prefetch = prefetch
+        self.labels = labels
+
+        # Slice counts and names from the headers only, so that len() and indexing work before any pixel is read
+        self.patients = []
+        self.slice_names = []
+        self.shapes = []  # Volume shape of every patient
+        self.series = []  # (series folder, series UID) of every patient, for its cache key
+        for folder in patient_folders:
+            series_folder = find_folder_with_max_files(folder)
+            if series_folder is None:
+                continue
+            index = index_scan(series_folder)
+            slice_names = [entry['name'] for entry in index]
+            shape = (len(index),) + tuple(index[0]['shape'])
+            if new_spacing is not None:  # Same shape as resample_volume in compute_intermediates
+                shape = tuple(int(n) for n in resampled_shape(shape, scan_spacing(index), new_spacing))
+                slice_names = resampled_slice_names(slice_names, shape[0])
+            self.patients.append(folder)
+            self.slice_names.append(slice_names)
+            self.shapes.append(shape)
+            self.series.append((series_folder, index[0]['series_uid']))
+        self.offsets = np.concatenate([[0], np.cumsum([len(n) for n in self.slice_names])]).astype(np.int64)
+
+        self._volumes = OrderedDict()  # patient number -> arrays, least recently used first
+        self._futures = {}
+        self._estimates = {}  # patient number -> estimate of a patient being loaded
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _load(self, p):
+        arrays, _ = load_intermediates(self.patients[p], self.new_spacing, self.cache, self.names)
+        return arrays
+
+    def _estimate(self, p):
+        # Upper bound of the bytes patient p holds while loading: the float32 HU, normalized and mask volumes of
+        # compute_intermediates, which are also computed in memory on a cache miss. 0 if its cache entry exists,
+        # the volumes are then only memory-mapped.
+        if self.cache is not None:
+            key, _ = intermediates_key(self.cache, *self.series[p], self.new_spacing)
+            if self.cache.has(key):
+                return 0
+        return 4 * 3 * int(np.prod(self.shapes[p]))
+
+    def _used(self):
+        # Bytes held by the loaded patients plus the estimate of the patients being loaded; call with the lock held
+        return (sum(_nbytes(a) for a in self._volumes.values())
+                + sum(self._estimates[q] for q in self._futures))
+
+    def _schedule(self, p, prefetch=False):
+        # Starts loading patient p unless it is cached or already loading; prefetches only start if they fit
+        # in memory_limit. Call with the lock held.
+        if p >= len(self.patients) or p in self._volumes or p in self._futures:
+            return
+        estimate = self._estimate(p)
+        if prefetch and self._used() + estimate > self.memory_limit:
+            return
+        self._estimates[p] = estimate
+        self._futures[p] = self._executor.submit(self._load, p)
+
+    def volumes(self, p):
+        """
+        Returns the arrays of patient number p, loading them if needed, and prefetches the
+        following patients.
+        """
+        with self._lock:
+            if p in self._volumes:
+                self._volumes.move_to_end(p)
+                arrays = self._volumes[p]
+            else:
+                arrays = None
+                self._schedule(p)
+                future = self._futures[p]
+            for q in range(p + 1, p + 1 + self.prefetch):
+                self._schedule(q, prefetch=True)
+        if arrays is not None:
+            return arrays
+
+        try:
+            arrays = future.result()
+        except BaseException:
+            with self._lock:
+                if self._futures.get(p) is future:
+                    del self._futures[p]
+            raise
+        # The future is replaced by the arrays in one step, so no other thread can miss both and load p again
+        with self._lock:
+            if self._futures.get(p) is future:
+                del self._futures[p]
+                self._volumes[p] = arrays
+            if p in self._volumes:
+                self._volumes.move_to_end(p)
+            while len(self._volumes) > 1 and self._used() > self.memory_limit:
+                self._volumes.popitem(last=False)
+        return arrays
+
+    def label(self, p, i):
+        patient = os.path.basename(os.path.normpath(self.patients[p]))
+        name = source_slice_name(self.slice_names[p][i])
+        if self.labels is None:
+            return -1
+        if callable(self.labels):
+            return self.labels(patient, name)
+        if isinstance(self.labels, dict):
+            return self.labels.get(f"{patient}/{name}", 0)
+        return int(f"{patient}/{name}" in self.labels)
+
+    def __getitem__(self, index):
+        """
+        Returns (slice, label) of sample index: the slice is a 2D array, or (channels, y, x) when
+        several names are served.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        p = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        i = int(index - self.offsets[p])
+        arrays = self.volumes(p)
+        if len(self.names) == 1:
+            image = np.asarray(arrays[self.names[0]][i])
+        else:
+            image = np.stack([np.asarray(arrays[name][i]) for name in self.names])
+        return image, self.label(p, i)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._volumes.clear()
+        self._futures.clear()
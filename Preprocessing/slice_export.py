@@ -0,0 +1,206 @@
+import io
+import json
+import os
+import queue
+import re
+import threading
+import numpy as np
+
+# Thread pool that encodes slice images and writes them to disk.
+# Encoding (PIL releases the GIL while encoding) runs on num_threads encoder threads, the encoded bytes are
+# written by a single writer thread. Both queues are bounded, so submit blocks instead of buffering a whole
+# volume of images when the disk is slower than the encoders.
+# The 16-bit helpers below export HU slices with one fixed window instead of a per-slice 8-bit rescale.
+# Resampled slices are named "<DICOM file name>_r<index>" after the source slice nearest to them, so the
+# label matching by DICOM file name (YOLO and CNN datasets) still works through source_slice_name.
+
+_STOP = object()
+RESAMPLED_NAME = re.compile(r'(.+)_r\d{4,}')  # "<source slice name>_r<index of the resampled slice>"
+
+#--------------------------------------------------------------------------------------------------------------
+
+class SliceExportPool:
+    def __init__(self, to_image, num_threads=4, max_queued=32, image_format='JPEG', buffer_size=1 << 20,
+                 **save_kwargs):
+        """
+        Parameters:
+        - to_image: Function converting a slice array to a PIL image, e.g. to_jpg.
+        - num_threads: Number of encoder threads.
+        - max_queued: Maximum number of slices (and of encoded images) waiting in each queue.
+        - image_format, save_kwargs: Passed to PIL's Image.save (e.g. quality=90).
+        - buffer_size: Buffer size of the files opened by the writer thread.
+        """
+        self.to_image = to_image
+        self.image_format = image_format
+        self.save_kwargs = save_kwargs
+        self.buffer_size = buffer_size
+        self.encode_queue = queue.Queue(maxsize=max_queued)
+        self.write_queue = queue.Queue(maxsize=max_queued)
+        self.written = []
+        self.bytes_written = 0
+        self.error = None
+        self.encoders = [threading.Thread(target=self._encode, daemon=True) for _ in range(num_threads)]
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        for thread in self.encoders:
+            thread.start()
+        self.writer.start()
+
+    def _encode(self):
+        while True:
+            item = self.encode_queue.get()
+            if item is _STOP:
+                return
+            path, pixel_array = item
+            if self.error is not None:
+                continue  # Drain the queue after a failure
+            try:
+                buffer = io.BytesIO()
+                self.to_image(pixel_array).save(buffer, format=self.image_format, **self.save_kwargs)
+                self.write_queue.put((path, buffer.getvalue()))
+            except Exception as e:
+                self.error = e
+
+    def _write(self):
+        while True:
+            item = self.write_queue.get()
+            if item is _STOP:
+                return
+            path, data = item
+            if self.error is not None:
+                continue
+            try:
+                with open(path, 'wb', buffering=self.buffer_size) as f:
+                    f.write(data)
+                self.written.append(path)
+                self.bytes_written += len(data)
+            except Exception as e:
+                self.error = e
+
+    def submit(self, path, pixel_array):
+        # Queues one slice, blocks while max_queued slices are waiting
+        if self.error is not None:
+            raise self.error
+        self.encode_queue.put((path, pixel_array))
+
+    def close(self):
+        """
+        Waits until every submitted slice is written and stops the threads.
+
+        Returns:
+        - Paths of the written files, in the order they were written.
+        """
+        for _ in self.encoders:
+            self.encode_queue.put(_STOP)
+        for thread in self.encoders:
+            thread.join()
+        self.write_queue.put(_STOP)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+        return self.written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.error = self.error or exc
+            try:
+                self.close()
+            except BaseException:
+                pass
+
+#--------------------------------------------------------------------------------------------------------------
+
+def source_slice_positions(n_source, n_resampled):
+    # Position of the source slice nearest to every resampled slice (resample_volume maps resampled slice o to
+    # source coordinate o * (n_source - 1) / (n_resampled - 1))
+    step = (n_source - 1) / (n_resampled - 1) if n_resampled > 1 else 0.
+    return np.rint(np.arange(n_resampled) * step).astype(np.int64)
+
+#--------------------------------------------------------------------------------------------------------------
+
+def resampled_slice_names(source_names, n_resampled):
+    # Names of the resampled slices: the name of their nearest source slice and their index
+    positions = source_slice_positions(len(source_names), n_resampled)
+    return [f"{source_names[j]}_r{i:04d}" for i, j in enumerate(positions.tolist())]
+
+#--------------------------------------------------------------------------------------------------------------
+
+def source_slice_name(name):
+    # Name of the DICOM slice a slice image stands for: "<name>_r0012" -> "<name>", other names unchanged
+    match = RESAMPLED_NAME.fullmatch(name)
+    return match.group(1) if match else name
+
+#--------------------------------------------------------------------------------------------------------------
+
+def hu_scale(window):
+    # Scale of hu_to_uint16: 1 (lossless for integer HU) unless the window is wider than the uint16 range
+    low, high = window
+    return min(1., 65535. / (high - low))
+
+#--------------------------------------------------------------------------------------------------------------
+
+def hu_to_uint16(hu, window, out=None):
+    """
+    Maps HU values to uint16 with a fixed global window: (clip(hu, low, high) - low) * hu_scale(window).
+    Unlike the per-slice min/max of to_jpg, every slice and patient shares one scale, and
+    uint16_to_hu inverts the mapping.
+    """
+    low, high = window
+    scaled = np.clip(hu, low, high).astype(np.float32)
+    scaled -= low
+    scaled *= hu_scale(window)
+    np.rint(scaled, out=scaled)
+    if out is None:
+        return scaled.astype(np.uint16)
+    out[...] = scaled
+    return out
+
+#--------------------------------------------------------------------------------------------------------------
+
+def uint16_to_hu(values, window):
+    low, _ = window
+    return values.astype(np.float32) / hu_scale(window) + low
+
+#--------------------------------------------------------------------------------------------------------------
+
+def save_raw_volume(folder, volume, file_names, window=None, dtype='uint16', **meta):
+    """
+    Writes a patient volume as folder/volume.npy plus folder/meta.json, to be opened without any
+    decoding with load_raw_volume. dtype 'uint16' stores hu_to_uint16(volume, window), 'float16'
+    stores the volume clipped to the window (exact for integer HU below 2048).
+
+    Returns:
+    - Names of the files written.
+    """
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, 'volume.npy')
+    array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=volume.shape)
+    for i in range(len(volume)):  # One slice at a time, no full-volume temporary
+        if dtype == 'uint16':
+            hu_to_uint16(volume[i], window, out=array[i])
+        else:
+            array[i] = np.clip(volume[i], *window) if window is not None else volume[i]
+    array.flush()
+    del array
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump(dict(meta, file_names=list(file_names), window=window, dtype=dtype,
+                       scale=hu_scale(window) if dtype == 'uint16' else 1.), f)
+    return ['volume.npy', 'meta.json']
+
+#--------------------------------------------------------------------------------------------------------------
+
+def load_raw_volume(folder):
+    """
+    Opens a volume written by save_raw_volume, memory-mapped: volume[i] is slice file_names[i] and
+    is read straight from the page cache.
+
+    Returns:
+    - (volume, meta dictionary)
+    """
+    with open(os.path.join(folder, 'meta.json')) as f:
+        meta = json.load(f)
+    return np.load(os.path.join(folder, 'volume.npy'), mmap_mode='r'), meta
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# Cache of per-patient intermediate volumes (HU, smoothed normalized volume, lung mask).
+# Every entry is a folder <series UID>_<hash of the parameters and input fingerprint> holding one .npy file
+# per volume and meta.json, so the volumes can be opened zero-copy with np.load(mmap_mode='r').
+
+#--------------------------------------------------------------------------------------------------------------
+
+def params_hash(params):
+    # Stable hash of a JSON-serializable dictionary of preprocessing parameters
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+#--------------------------------------------------------------------------------------------------------------
+
+class VolumeCache:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, series_uid, params):
+        return f"{series_uid}_{params_hash(params)}"
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def has(self, key):
+        return os.path.isfile(os.path.join(self.path(key), 'meta.json'))
+
+    def save(self, key, arrays, meta):
+        """
+        Stores the arrays (dictionary name -> ndarray, None values are skipped) and the
+        JSON-serializable meta dictionary under key. The entry is written to a temporary folder
+        and renamed, so readers never see a partial entry.
+        """
+        tmp = tempfile.mkdtemp(prefix=f".{key}.", dir=self.root)
+        try:
+            stored = {}
+            for name, array in arrays.items():
+                if array is None:
+                    continue
+                np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(array))
+                stored[name] = {'shape': list(array.shape), 'dtype': str(array.dtype)}
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(dict(meta, key=key, arrays=stored), f)
+            final = self.path(key)
+            if os.path.exists(final):
+                shutil.rmtree(final)
+            os.replace(tmp, final)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return final
+
+    def load_meta(self, key):
+        with open(os.path.join(self.path(key), 'meta.json')) as f:
+            return json.load(f)
+
+    def load(self, key, names=None, mmap_mode='r'):
+        """
+        Opens the arrays of an entry, memory-mapped read-only by default.
+
+        Returns:
+        - (dictionary name -> array, meta dictionary)
+        """
+        meta = self.load_meta(key)
+        names = meta['arrays'].keys() if names is None else names
+        arrays = {name: np.load(os.path.join(self.path(key), f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in names}
+        return arrays, meta
+
+    def keys(self):
+        return sorted(k for k in os.listdir(self.root) if not k.startswith('.') and self.has(k))
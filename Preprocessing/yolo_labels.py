@@ -0,0 +1,150 @@
+import os
+import numpy as np
+import pandas as pd
+from consensus import consensus
+from dataset_staging import stage_files
+from slice_export import source_slice_name
+
+# YOLO label files straight from the nodule table: one <patient>_<DICOM file name>.txt per annotated slice
+# with one line "class x_center y_center width height" (normalized) per box. Replaces the former round trip
+# through per-slice text files parsed with regular expressions, which kept only the first box of a slice.
+# The boxes are the ones of that parser: normal nodules (with a malignancy rating) are class 1 with their ROI
+# rectangle, non nodules class 0 with a 10x10 box around their center. Small nodules get no box, as their
+# text files never matched its regular expressions.
+
+DEFAULT_BOX = 10  # Width and height of class 0 boxes, in pixels
+LABEL_TYPES = ['N', 'NN']  # Nodule types with a box
+
+#--------------------------------------------------------------------------------------------------------------
+
+def yolo_boxes(table, rows, image_width=512, image_height=512):
+    """
+    Computes the normalized boxes of rows of a NoduleTable.
+
+    Returns:
+    - (classes, x_center, y_center, width, height) arrays, one entry per row.
+    """
+    c = table.columns
+    normal = (c['nodule_type'][rows] == 'N') & (c['malig'][rows] != 0)
+    classes = normal.astype(np.int64)
+    width = np.where(normal, c['xmax'][rows] - c['xmin'][rows], DEFAULT_BOX) / image_width
+    height = np.where(normal, c['ymax'][rows] - c['ymin'][rows], DEFAULT_BOX) / image_height
+    return classes, c['cx'][rows] / image_width, c['cy'][rows] / image_height, width, height
+
+#--------------------------------------------------------------------------------------------------------------
+
+def consensus_boxes(table, min_readers=1, image_width=512, image_height=512, **cluster_kwargs):
+    """
+    Normalized boxes of the merged readings of consensus.consensus agreed on by at least
+    min_readers radiologists, over the inclusion ROIs of LABEL_TYPES. Every nodule type is
+    clustered on its own, so a rectangle is never merged with (and its readers never counted
+    together with) the point of a non nodule. Clusters with a malignancy rating are class 1 with
+    their mean rectangle, the others class 0 with a 10x10 box around their mean center.
+
+    Returns:
+    - DataFrame with the columns 'SOP-UID', 'class', 'x', 'y', 'w', 'h'.
+    """
+    slices = pd.concat([consensus(table, table.select(nodule_type=nodule_type, inclusion=True), **cluster_kwargs)[0]
+                        for nodule_type in LABEL_TYPES], ignore_index=True)
+    slices = slices[slices['Readers'] >= min_readers]
+    rated = slices['Mean malignancy'].notna().to_numpy()
+    return pd.DataFrame({
+        'SOP-UID': slices['SOP-UID'].to_numpy(), 'class': rated.astype(np.int64),
+        'x': slices['cx'].to_numpy() / image_width, 'y': slices['cy'].to_numpy() / image_height,
+        'w': np.where(rated, slices['xmax'] - slices['xmin'], DEFAULT_BOX) / image_width,
+        'h': np.where(rated, slices['ymax'] - slices['ymin'], DEFAULT_BOX) / image_height})
+
+#--------------------------------------------------------------------------------------------------------------
+
+def build_yolo_labels(table, files, output_directory, image_width=512, image_height=512, min_readers=None):
+    """
+    Writes the YOLO label files of every slice with annotations. The ROIs of all radiologists are
+    written to the label file of their slice; boxes drawn identically by several radiologists,
+    exclusion ROIs (inclusion FALSE, holes of a nodule) and small nodules are left out.
+
+    Parameters:
+    - table: NoduleTable of the patients.
+    - files: DataFrame with the columns 'SOP-UID' and 'File' ("<patient>/<DICOM file name without
+      .dcm>"), e.g. SopIndex.patient_frame().
+    - output_directory: Folder for the label files, created if needed.
+    - min_readers: If given, writes the merged boxes of consensus_boxes instead of the boxes of
+      every radiologist.
+
+    Returns:
+    - Names of the label files written.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    if min_readers is None:
+        rows = table.select(nodule_type=LABEL_TYPES, inclusion=True)
+        classes, x, y, w, h = yolo_boxes(table, rows, image_width, image_height)
+        boxes = pd.DataFrame({'SOP-UID': table.columns['sop_uid'][rows], 'class': classes,
+                              'x': x, 'y': y, 'w': w, 'h': h})
+        boxes = boxes.drop_duplicates()
+    else:
+        boxes = consensus_boxes(table, min_readers, image_width, image_height)
+
+    # One join from SOP-UID to label file name
+    files = files[['SOP-UID', 'File']].drop_duplicates('SOP-UID')
+    boxes = boxes.merge(files, on='SOP-UID', how='inner')
+    boxes['File'] = boxes['File'].str.replace('/', '_', regex=False)
+    boxes = boxes.sort_values('File', kind='stable')
+
+    lines = [f"{k} {a} {b} {c} {d}\n" for k, a, b, c, d in zip(
+        boxes['class'].tolist(), boxes['x'].tolist(), boxes['y'].tolist(), boxes['w'].tolist(), boxes['h'].tolist())]
+    names = boxes['File'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]]) if len(names) else np.zeros(0, dtype=np.int64)
+    ends = np.append(starts[1:], len(names))
+    written = []
+    for start, end in zip(starts.tolist(), ends.tolist()):  # One write per label file
+        name = f"{names[start]}.txt"
+        with open(os.path.join(output_directory, name), 'w') as f:
+            f.write("".join(lines[start:end]))
+        written.append(name)
+    print(f"Wrote {len(written)} label files ({len(lines)} boxes) to {output_directory}")
+    return written
+
+#--------------------------------------------------------------------------------------------------------------
+
+def slice_labels(table, sop_uids, image_width=512, image_height=512):
+    """
+    Labels of a list of slices, e.g. the slices of a patient for the shard records of
+    save_patient_shards.
+
+    Returns:
+    - List with one dictionary per SOP-UID: 'boxes', the [class, x_center, y_center, width,
+      height] boxes of the slice as in build_yolo_labels, and 'cancerous', True if a normal
+      nodule has an ROI on the slice (as Cancerous_slices of the CNN split).
+    """
+    rows = table.select(nodule_type=LABEL_TYPES, inclusion=True, sop_uids=[uid for uid in sop_uids if uid is not None])
+    classes, x, y, w, h = yolo_boxes(table, rows, image_width, image_height)
+    boxes = pd.DataFrame({'SOP-UID': table.columns['sop_uid'][rows], 'class': classes,
+                          'x': x, 'y': y, 'w': w, 'h': h}).drop_duplicates()
+    by_uid = {}
+    for uid, *box in zip(boxes['SOP-UID'].tolist(), boxes['class'].tolist(), boxes['x'].tolist(),
+                         boxes['y'].tolist(), boxes['w'].tolist(), boxes['h'].tolist()):
+        by_uid.setdefault(uid, []).append(box)
+    cancerous = set(table.columns['sop_uid'][table.select(nodule_type='N')].tolist())
+    return [{'boxes': by_uid.get(uid, []), 'cancerous': uid in cancerous} for uid in sop_uids]
+
+#--------------------------------------------------------------------------------------------------------------
+
+def link_resampled_labels(label_directory, image_directory, mode='link'):
+    """
+    Gives every resampled image "<patient>_<DICOM file name>_r<index>.jpg" of image_directory the
+    label file of its nearest DICOM slice, staged (hard-linked by default, see
+    dataset_staging.stage_files) as "<patient>_<DICOM file name>_r<index>.txt" in label_directory.
+
+    Returns:
+    - Number of label files staged.
+    """
+    labels = {os.path.splitext(name)[0] for name in os.listdir(label_directory) if name.endswith('.txt')}
+    pairs = []
+    with os.scandir(image_directory) as entries:
+        for entry in entries:
+            stem = os.path.splitext(entry.name)[0]
+            source = source_slice_name(stem)
+            if source != stem and source in labels:
+                pairs.append((os.path.join(label_directory, f"{source}.txt"),
+                              os.path.join(label_directory, f"{stem}.txt")))
+    stage_files(pairs, mode)
+    return len(pairs)
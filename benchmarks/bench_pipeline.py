@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'xml_parser'))
+sys.path.insert(0, os.path.join(HERE, '..', 'Preprocessing'))
+import annotation
+from Preprocessing_steps import (load_scan, get_pixels_hounds, to_hounds, segment_lung_mask, resample, to_jpg,
+                                 find_folder_with_max_files)
+from nodule_table import NoduleTable
+from sop_index import SopIndex
+from yolo_labels import build_yolo_labels
+from synthetic_lidc import make_dataset
+
+# Times the stages of the preprocessing and annotation pipeline on a synthetic LIDC dataset and writes the
+# results as JSON, to compare commits (e.g. in a nightly run):
+#   python bench_pipeline.py --patients 2 --slices 64 --size 128 --output results.json
+# Every stage is run --repeats times per patient; the JSON holds the best and mean wall time of each stage, its
+# peak traced memory (tracemalloc, includes NumPy buffers, measured in one extra untimed run) and the peak RSS
+# of the process.
+
+STAGES = ('load_scan', 'get_pixels_hounds', 'segment_lung_mask', 'resample', 'to_jpg', 'annotation.parse',
+          'annotation.parse_columnar', 'sop_index', 'yolo_labels')
+
+#--------------------------------------------------------------------------------------------------------------
+
+def measure(function, *args, repeats=3):
+    """
+    Runs function(*args) repeats times with tracemalloc off for the wall times, then once more
+    with tracemalloc on for the peak memory, whose tracing overhead would skew the times.
+
+    Returns:
+    - (dictionary with 'times' (seconds) and 'peak_bytes' (tracemalloc peak), result of the last timed run)
+    """
+    times = []
+    result = None
+    for _ in range(repeats):
+        result = None  # Do not keep the previous result alive during the run
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+
+    traced = None
+    tracemalloc.start()
+    try:
+        traced = function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del traced
+    return {'times': times, 'peak_bytes': peak}, result
+
+#--------------------------------------------------------------------------------------------------------------
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#--------------------------------------------------------------------------------------------------------------
+
+def run_benchmarks(root, stages=STAGES, repeats=3):
+    """
+    Runs the stages on every patient folder of root.
+
+    Returns:
+    - Dictionary stage -> {'best_s', 'mean_s', 'total_s', 'runs', 'peak_bytes'}.
+    """
+    runs = {stage: {'times': [], 'peak_bytes': 0} for stage in stages}
+
+    def record(stage, function, *args):
+        if stage not in runs:
+            return None
+        stats, result = measure(function, *args, repeats=repeats)
+        runs[stage]['times'] += stats['times']
+        runs[stage]['peak_bytes'] = max(runs[stage]['peak_bytes'], stats['peak_bytes'])
+        return result
+
+    patients = sorted(p for p in os.listdir(root) if os.path.isdir(os.path.join(root, p)))
+    for patient in patients:
+        series_folder = find_folder_with_max_files(os.path.join(root, patient))
+        scan = record('load_scan', load_scan, series_folder)
+        if scan is None:  # Stage not selected, its result is still the input of the next stages
+            scan = load_scan(series_folder)
+        slices = [s for s, _ in scan]
+        normalized = record('get_pixels_hounds', get_pixels_hounds, slices)
+        if normalized is None:
+            normalized = get_pixels_hounds(slices)
+        record('segment_lung_mask', segment_lung_mask, normalized, False)
+        hu = to_hounds(np.stack([s.pixel_array for s in slices]), [s.RescaleSlope for s in slices],
+                       [s.RescaleIntercept for s in slices])
+        record('resample', resample, hu, slices, [1, 1, 1], 1)
+        record('to_jpg', lambda volume: [to_jpg(s) for s in volume], normalized)
+        xml_file = annotation.find_xml_file(series_folder)
+        record('annotation.parse', annotation.parse, xml_file)
+        record('annotation.parse_columnar', annotation.parse_columnar, xml_file)
+
+    columns = {p: annotation.parse_columnar(annotation.find_xml_file(find_folder_with_max_files(os.path.join(root, p))))
+               for p in patients}
+
+    def index_dataset():
+        with SopIndex(':memory:') as sop_index:
+            sop_index.update(root)
+            return sop_index.patient_frame()
+
+    files = record('sop_index', index_dataset)
+    if files is None:
+        files = index_dataset()
+    with tempfile.TemporaryDirectory() as labels_folder:
+        record('yolo_labels', lambda: build_yolo_labels(NoduleTable(columns), files, labels_folder))
+
+    results = {}
+    for stage, run in runs.items():
+        times = run['times']
+        results[stage] = {'best_s': min(times), 'mean_s': float(np.mean(times)), 'total_s': float(np.sum(times)),
+                          'runs': len(times), 'peak_bytes': run['peak_bytes']}
+    return results
+
+#--------------------------------------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing and annotation stages.")
+    parser.add_argument('--patients', type=int, default=2)
+    parser.add_argument('--slices', type=int, default=64)
+    parser.add_argument('--size', type=int, default=128, help="Rows and columns of the slices")
+    parser.add_argument('--nodules', type=int, default=6, help="Nodules per radiologist")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--data', help="Folder for the synthetic dataset (default: temporary, removed after the run)")
+    parser.add_argument('--output', help="JSON file for the results (default: print only)")
+    args = parser.parse_args(argv)
+
+    config = {k: getattr(args, k) for k in ('patients', 'slices', 'size', 'nodules', 'repeats')}
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.data or tmp
+        start = time.perf_counter()
+        make_dataset(root, args.patients, args.slices, args.size, args.nodules)
+        generate_s = time.perf_counter() - start
+        stages = run_benchmarks(root, args.stages, args.repeats)
+
+    report = {
+        'commit': _git_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'config': config,
+        'generate_s': generate_s,
+        'stages': stages,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,  # ru_maxrss is in KiB on Linux
+    }
+    for stage, result in stages.items():
+        print(f"{stage:28s} best {result['best_s']:8.4f} s  mean {result['mean_s']:8.4f} s  "
+              f"peak {result['peak_bytes'] / 2 ** 20:8.1f} MiB")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Preprocessing'))
+from Preprocessing_steps import segment_lung_mask, segment_lung_mask_fast
+
+# Compares segment_lung_mask with segment_lung_mask_fast on synthetic normalized CT volumes
+# Usage: python bench_segmentation.py [n_slices] [size] [repeats]
+
+#--------------------------------------------------------------------------------------------------------------
+
+def synthetic_volume(n_slices=128, size=256, seed=0):
+    """
+    Normalized (lung window) volume with a body, two lungs, small air pockets, vessels inside the
+    lungs and a table under the patient touching the border of the image.
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[:n_slices, :size, :size]
+    c = size / 2
+    image = np.full((n_slices, size, size), 0.02, dtype=np.float32)  # Air around the body
+    body = ((y - c) / (0.38 * size)) ** 2 + ((x - c) / (0.45 * size)) ** 2 < 1
+    image[np.broadcast_to(body, image.shape)] = 0.75
+    length = 0.4 * n_slices * (1 - ((z - n_slices / 2) / (0.55 * n_slices)) ** 2)
+    for cx in (0.3 * size, 0.7 * size):
+        lung = ((y - c) / (0.25 * size)) ** 2 + ((x - cx) / (0.12 * size)) ** 2 < np.clip(length / (0.4 * n_slices), 0, 1)
+        image[lung] = 0.1
+    for _ in range(8):  # Air pockets inside the body (bowel gas)
+        pz, py, px = rng.integers(0, n_slices), rng.integers(int(0.75 * size), int(0.8 * size)), rng.integers(int(0.3 * size), int(0.7 * size))
+        image[max(pz - 3, 0):pz + 3, py - 3:py + 3, px - 3:px + 3] = 0.05
+    for _ in range(40):  # Vessels inside the lungs
+        py, px = rng.integers(int(0.3 * size), int(0.7 * size)), rng.integers(int(0.2 * size), int(0.8 * size))
+        image[:, py:py + 2, px:px + 2] = np.maximum(image[:, py:py + 2, px:px + 2], 0.6)
+    image[:, int(0.92 * size):int(0.94 * size), :] = 0.8  # Table cutting the air in half
+    image += rng.normal(0, 0.02, image.shape).astype(np.float32)
+    return image
+
+#--------------------------------------------------------------------------------------------------------------
+
+def timed(function, *args, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+#--------------------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    n_slices = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    image = synthetic_volume(n_slices, size)
+    print(f"Volume {image.shape}, best of {repeats}")
+
+    for fill in (False, True):
+        t_ref, ref = timed(segment_lung_mask, image, fill, repeats=repeats)
+        t_same, same = timed(lambda im, f: segment_lung_mask_fast(im, f, border_seeds=False), image, fill, repeats=repeats)
+        t_fast, fast = timed(segment_lung_mask_fast, image, fill, repeats=repeats)
+        print(f"fill_lung_structures={fill}")
+        print(f"  segment_lung_mask                          {t_ref:8.3f} s")
+        print(f"  segment_lung_mask_fast(border_seeds=False) {t_same:8.3f} s  x{t_ref / t_same:5.1f}  identical: {np.array_equal(ref, same)}")
+        print(f"  segment_lung_mask_fast                     {t_fast:8.3f} s  x{t_ref / t_fast:5.1f}  "
+              f"lung voxels {int(ref.sum())} -> {int(fast.sum())}")
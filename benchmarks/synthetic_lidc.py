@@ -0,0 +1,132 @@
+import os
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# Offline generator of LIDC-IDRI-like test data: CT series of synthetic chests (body, two lungs, noise) as
+# DICOM files in <root>/<patient>/study/series/, with an LIDC XML annotation file whose ROIs refer to the
+# SOP-UIDs and slice positions of the series. Sizes are configurable, so the benchmarks can be run at
+# anything from smoke-test to full-scan scale.
+
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+CHARACTERISTIC_TAGS = ('subtlety', 'internalStructure', 'calcification', 'sphericity', 'margin', 'lobulation',
+                       'spiculation', 'texture', 'malignancy')
+
+#--------------------------------------------------------------------------------------------------------------
+
+def synthetic_slice(size, rng):
+    # Stored pixel values (HU + 1024) of one axial slice
+    y, x = np.mgrid[:size, :size]
+    c = size / 2
+    image = np.full((size, size), 1024 - 900, dtype=np.int16)
+    image[((y - c) ** 2 + (x - c) ** 2) < (0.42 * size) ** 2] = 1024 + 40
+    for cx in (0.35 * size, 0.65 * size):
+        image[((y - c) / (0.25 * size)) ** 2 + ((x - cx) / (0.1 * size)) ** 2 < 1] = 1024 - 850
+    return image + rng.integers(-20, 20, image.shape).astype(np.int16)
+
+#--------------------------------------------------------------------------------------------------------------
+
+def make_series(folder, patient, n_slices=64, size=128, slice_thickness=2.5, seed=0):
+    """
+    Writes n_slices DICOM files 1-001.dcm, 1-002.dcm, ... (in shuffled z order, as in LIDC) to folder.
+
+    Returns:
+    - List of (SOP-UID, z position) of the slices, sorted by z.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    series_uid = generate_uid()
+    positions = -np.arange(n_slices) * slice_thickness
+    rng.shuffle(positions)
+    slices = []
+    for i, z in enumerate(positions):
+        sop_uid = generate_uid()
+        meta = FileMetaDataset()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+        meta.MediaStorageSOPInstanceUID = sop_uid
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+        ds.SOPClassUID = CT_IMAGE_STORAGE
+        ds.SOPInstanceUID = sop_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.PatientID = patient
+        ds.ImagePositionPatient = [0., 0., float(z)]
+        ds.SliceLocation = float(z)
+        ds.SliceThickness = slice_thickness
+        ds.PixelSpacing = [0.7, 0.7]
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.Rows = ds.Columns = size
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.PixelData = synthetic_slice(size, rng).tobytes()
+        ds.save_as(os.path.join(folder, f"1-{i + 1:03d}.dcm"))  # Encoded as the TransferSyntaxUID of the file meta
+        slices.append((sop_uid, float(z)))
+    return sorted(slices, key=lambda s: s[1])
+
+#--------------------------------------------------------------------------------------------------------------
+
+def make_xml(path, slices, size=128, n_sessions=4, n_nodules=6, max_rois=5, max_points=40, seed=0):
+    """
+    Writes an LIDC XML file with n_sessions reading sessions of n_nodules nodules each (normal,
+    small or non nodules at random) on the given (SOP-UID, z) slices.
+    """
+    rng = np.random.default_rng(seed)
+    out = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<LidcReadMessage xmlns="http://www.nih.gov" uid="1">',
+           '<ResponseHeader><Version>1.8</Version></ResponseHeader>']
+    margin = max(size // 8, 12)
+    for session in range(n_sessions):
+        out.append(f'<readingSession><annotationVersion>3.12</annotationVersion>'
+                   f'<servicingRadiologistID>{session}</servicingRadiologistID>')
+        for k in range(n_nodules):
+            kind = rng.choice(['N', 'S', 'NN'])
+            first = int(rng.integers(0, max(len(slices) - max_rois, 1)))
+            cx, cy = rng.integers(margin, size - margin, 2)
+            if kind == 'NN':
+                sop_uid, z = slices[first]
+                out.append(f'<nonNodule><nonNoduleID>NN{k}</nonNoduleID><imageZposition>{z}</imageZposition>'
+                           f'<imageSOP_UID>{sop_uid}</imageSOP_UID>'
+                           f'<locus><xCoord>{cx}</xCoord><yCoord>{cy}</yCoord></locus></nonNodule>')
+                continue
+            out.append(f'<unblindedReadNodule><noduleID>Nodule {k:03d}</noduleID>')
+            if kind == 'N':
+                ratings = rng.integers(1, 6, len(CHARACTERISTIC_TAGS))
+                out.append('<characteristics>' + ''.join(f'<{t}>{v}</{t}>' for t, v in zip(CHARACTERISTIC_TAGS, ratings))
+                           + '</characteristics>')
+            for sop_uid, z in slices[first:first + int(rng.integers(1, max_rois + 1))]:
+                inclusion = "TRUE" if rng.random() < 0.9 else "FALSE"
+                out.append(f'<roi><imageZposition>{z}</imageZposition><imageSOP_UID>{sop_uid}</imageSOP_UID>'
+                           f'<inclusion>{inclusion}</inclusion>')
+                n_points = 1 if kind == 'S' else int(rng.integers(3, max_points))
+                radius = rng.integers(3, 12, n_points)
+                angle = 2 * np.pi * np.arange(n_points) / n_points
+                for x, y in zip((cx + radius * np.cos(angle)).astype(int), (cy + radius * np.sin(angle)).astype(int)):
+                    out.append(f'<edgeMap><xCoord>{x}</xCoord><yCoord>{y}</yCoord></edgeMap>')
+                out.append('</roi>')
+            out.append('</unblindedReadNodule>')
+        out.append('</readingSession>')
+    out.append('</LidcReadMessage>')
+    with open(path, 'w') as f:
+        f.write('\n'.join(out))
+
+#--------------------------------------------------------------------------------------------------------------
+
+def make_dataset(root, n_patients=2, n_slices=64, size=128, n_nodules=6, seed=0):
+    """
+    Writes n_patients patients LIDC-IDRI-0001, ... with a series and an XML file each.
+
+    Returns:
+    - List of the patient folders.
+    """
+    folders = []
+    for k in range(n_patients):
+        patient = f"LIDC-IDRI-{k + 1:04d}"
+        series_folder = os.path.join(root, patient, 'study', 'series')
+        slices = make_series(series_folder, patient, n_slices, size, seed=seed + k)
+        make_xml(os.path.join(series_folder, f"{k:03d}.xml"), slices, size, n_nodules=n_nodules, seed=seed + k)
+        folders.append(os.path.join(root, patient))
+    return folders
@@ -0,0 +1,46 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ('Preprocessing', 'xml_parser', 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from annotation import parse, parse_columnar, columns_to_frames, columns_to_records
+from synthetic_lidc import make_series, make_xml
+
+#--------------------------------------------------------------------------------------------------------------
+
+def synthetic_xml(tmp_path):
+    slices = make_series(str(tmp_path / 'series'), 'LIDC-IDRI-0001', n_slices=10, size=64)
+    path = str(tmp_path / 'series' / '000.xml')
+    make_xml(path, slices, size=64, n_nodules=8)
+    return path
+
+def test_parse_columnar_records_match_parse(tmp_path):
+    xml_file = synthetic_xml(tmp_path)
+    annotations, char_list = parse(xml_file)
+    assert {a['Nodule Type'] for a in annotations} == {'N', 'S', 'NN'}
+    assert columns_to_records(*parse_columnar(xml_file)) == (annotations, char_list)
+
+def test_parse_columnar_frames_match_parse(tmp_path):
+    xml_file = synthetic_xml(tmp_path)
+    annotations, char_list = parse(xml_file)
+    expected = pd.DataFrame(annotations)
+    frame, char_frame = columns_to_frames(*parse_columnar(xml_file))
+    assert list(frame.columns) == list(expected.columns)
+
+    for column in ("Radiologist No.", "Nodule Type", "No.", "Nodule ID", "Z-Coordinate", "SOP-UID",
+                   "No. of ROI points"):
+        assert frame[column].tolist() == expected[column].tolist(), column
+    # Native values in the frames where parse has strings and "NA"
+    assert frame["Inclusion"].astype(str).tolist() == expected["Inclusion"].tolist()
+    points = [str([tuple(p) for p in a.tolist()]) if t == 'NN' else str(a.tolist())
+              for a, t in zip(frame["List of ROI points"], frame["Nodule Type"])]
+    assert points == expected["List of ROI points"].tolist()
+    for column in ("ROI Centroid", "ROI Rectangle"):
+        values = ["NA" if v is None else tuple(v) for v in frame[column]]
+        assert values == [v if isinstance(v, str) else tuple(np.asarray(v).tolist()) for v in expected[column]]
+
+    pd.testing.assert_frame_equal(char_frame, pd.DataFrame(char_list), check_dtype=False)
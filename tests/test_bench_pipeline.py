@@ -0,0 +1,20 @@
+import json
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ('Preprocessing', 'xml_parser', 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from bench_pipeline import STAGES, main
+
+#--------------------------------------------------------------------------------------------------------------
+
+def test_benchmark_harness_runs_every_stage(tmp_path):
+    output = str(tmp_path / 'results.json')
+    main(['--patients', '1', '--slices', '6', '--size', '32', '--nodules', '2', '--repeats', '1',
+          '--data', str(tmp_path / 'data'), '--output', output])
+    with open(output) as f:
+        report = json.load(f)
+    assert list(report['stages']) == list(STAGES)
+    assert all(stage['runs'] == 1 and stage['best_s'] >= 0 for stage in report['stages'].values())
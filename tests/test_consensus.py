@@ -0,0 +1,63 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ('Preprocessing', 'xml_parser', 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from annotation import parse_columnar
+from consensus import consensus
+from nodule_table import NoduleTable
+from yolo_labels import consensus_boxes
+
+SOP_UID = '1.2.3.4'
+
+#--------------------------------------------------------------------------------------------------------------
+
+def rated_nodule(xmin, ymin, xmax, ymax, malignancy=4):
+    # Normal nodule reading: one ROI rectangle on the slice SOP_UID
+    edges = ''.join(f'<edgeMap><xCoord>{x}</xCoord><yCoord>{y}</yCoord></edgeMap>'
+                    for x, y in ((xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)))
+    return (f'<unblindedReadNodule><noduleID>Nodule 001</noduleID><characteristics>'
+            f'<malignancy>{malignancy}</malignancy></characteristics>'
+            f'<roi><imageZposition>-10.0</imageZposition><imageSOP_UID>{SOP_UID}</imageSOP_UID>'
+            f'<inclusion>TRUE</inclusion>{edges}</roi></unblindedReadNodule>')
+
+def non_nodule(x, y):
+    return (f'<nonNodule><nonNoduleID>NN1</nonNoduleID><imageZposition>-10.0</imageZposition>'
+            f'<imageSOP_UID>{SOP_UID}</imageSOP_UID><locus><xCoord>{x}</xCoord><yCoord>{y}</yCoord></locus>'
+            f'</nonNodule>')
+
+def make_table(path, sessions):
+    # NoduleTable of one patient whose reading sessions hold the given readings (lists of XML strings)
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?><LidcReadMessage xmlns="http://www.nih.gov" uid="1">'
+                + ''.join(f'<readingSession><servicingRadiologistID>{i}</servicingRadiologistID>'
+                          + ''.join(readings) + '</readingSession>' for i, readings in enumerate(sessions))
+                + '</LidcReadMessage>')
+    return NoduleTable({'LIDC-IDRI-0001': parse_columnar(path)})
+
+#--------------------------------------------------------------------------------------------------------------
+
+def test_consensus_boxes_keep_nodule_types_apart(tmp_path):
+    table = make_table(str(tmp_path / 'a.xml'), [[rated_nodule(100, 100, 120, 120)], [non_nodule(112, 108)]])
+    boxes = consensus_boxes(table, image_width=1, image_height=1).sort_values('class')
+    assert boxes['class'].tolist() == [0, 1]
+    assert boxes[['x', 'y', 'w', 'h']].values.tolist() == [[112, 108, 10, 10], [110, 110, 20, 20]]
+    assert consensus_boxes(table, min_readers=2).empty
+
+def test_consensus_averages_rectangles_of_one_nodule_type(tmp_path):
+    small_nodule = (f'<unblindedReadNodule><noduleID>Nodule 002</noduleID>'
+                    f'<roi><imageZposition>-10.0</imageZposition><imageSOP_UID>{SOP_UID}</imageSOP_UID>'
+                    f'<inclusion>TRUE</inclusion><edgeMap><xCoord>111</xCoord><yCoord>109</yCoord></edgeMap>'
+                    f'</roi></unblindedReadNodule>')
+    table = make_table(str(tmp_path / 'a.xml'), [[rated_nodule(100, 100, 120, 120)],
+                                                 [rated_nodule(102, 98, 118, 124, malignancy=2)], [small_nodule]])
+    slices, nodules = consensus(table)
+    slices = slices.sort_values('Readers', ascending=False)
+    assert slices['Readers'].tolist() == [2, 1]
+    rated = slices.iloc[0]
+    assert [rated[k] for k in ('xmin', 'ymin', 'xmax', 'ymax', 'Mean malignancy')] == [101, 99, 119, 122, 3]
+    point = slices.iloc[1]
+    assert [point[k] for k in ('xmin', 'ymin', 'xmax', 'ymax')] == [111, 109, 111, 109]
+    assert sorted(nodules['Readers'].tolist()) == [1, 2]
@@ -0,0 +1,58 @@
+import os
+import sys
+import numpy as np
+from PIL import Image
+from scipy.ndimage import gaussian_filter, zoom
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ('Preprocessing', 'xml_parser', 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from Preprocessing_steps import (process_and_save_patient, load_intermediates, multi_window, CT_WINDOWS,
+                                 EXPORT_WINDOWS, smooth_volume, resample_volume, resampled_shape)
+from synthetic_lidc import make_dataset
+
+#--------------------------------------------------------------------------------------------------------------
+
+def test_windows_export_has_one_channel_per_window(tmp_path):
+    patient_folder, = make_dataset(str(tmp_path / 'data'), n_patients=1, n_slices=6, size=64)
+    name, saved = process_and_save_patient(patient_folder, str(tmp_path / 'out'), export_format='windows',
+                                           num_threads=2)
+    arrays, meta = load_intermediates(patient_folder, names=('hu',))
+    assert saved == [os.path.join(name, f"{f}.jpg") for f in meta['file_names']]
+
+    image = np.asarray(Image.open(tmp_path / 'out' / saved[0]), dtype=np.float32)
+    expected = multi_window(arrays['hu'][:1], EXPORT_WINDOWS)[0] * 255
+    assert image.shape == (64, 64, 3)
+    # Compared per channel: JPEG smooths the pixel noise of the synthetic slices away, and clips it at 0 in the
+    # mostly dark bone window
+    assert np.allclose(image.mean(axis=(0, 1)), expected.mean(axis=(0, 1)), atol=3)
+    assert len({CT_WINDOWS[w] for w in EXPORT_WINDOWS}) == 3
+
+def test_smooth_volume_matches_gaussian_filter():
+    image = np.random.default_rng(0).normal(size=(50, 24, 20)).astype(np.float32)
+    for sigma, num_threads in ((1, 1), ((2, 1, 0.5), 3)):
+        expected = gaussian_filter(image, sigma, output=np.float32)
+        # Slabs of 8 slices with halos of up to 8 slices
+        assert np.array_equal(smooth_volume(image, sigma, slab_size=8, num_threads=num_threads), expected)
+
+def test_resample_volume_matches_zoom():
+    rng = np.random.default_rng(0)
+    image = rng.normal(size=(40, 16, 12)).astype(np.float32)
+    # Isotropic and anisotropic spacings, upsampling z and downsampling y
+    for spacing, new_spacing in (((1, 1, 1), (0.5, 0.5, 0.5)), ((2.5, 0.7, 0.8), (1, 1, 1))):
+        shape = resampled_shape(image.shape, spacing, new_spacing)
+        expected = zoom(image, shape / np.array(image.shape), order=1, mode='nearest')
+        resampled, _ = resample_volume(image, spacing, new_spacing, order=1, slab_size=8)
+        assert resampled.shape == expected.shape == tuple(shape)
+        np.testing.assert_allclose(resampled, expected, rtol=0, atol=1e-5)
+
+    # Order 0 matches except at output slices exactly halfway between two input slices
+    labels = rng.integers(0, 5, size=(30, 16, 12)).astype(np.float32)
+    spacing, new_spacing = (2.5, 0.7, 0.7), (1, 1, 1)
+    shape = resampled_shape(labels.shape, spacing, new_spacing)
+    expected = zoom(labels, shape / np.array(labels.shape), order=0, mode='nearest')
+    resampled, _ = resample_volume(labels, spacing, new_spacing, order=0, slab_size=8)
+    z = np.arange(shape[0]) * (labels.shape[0] - 1) / (shape[0] - 1)
+    exact = np.abs(z - np.floor(z) - 0.5) > 1e-6
+    assert np.array_equal(resampled[exact], expected[exact])
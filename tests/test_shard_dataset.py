@@ -0,0 +1,71 @@
+import os
+import sys
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ('Preprocessing', 'xml_parser', 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from Preprocessing_steps import (process_and_save_patient, find_folder_with_max_files, index_scan, run_patients,
+                                 save_patient_shards)
+from annotation import find_xml_file, parse_columnar
+from nodule_table import NoduleTable
+from shard_dataset import ShardReader, ShardWriter
+from synthetic_lidc import make_dataset
+from yolo_labels import yolo_boxes
+
+#--------------------------------------------------------------------------------------------------------------
+
+def test_shard_records_carry_slice_labels(tmp_path):
+    patient_folder, = make_dataset(str(tmp_path / 'data'), n_patients=1, n_slices=12, size=64, n_nodules=6)
+    patient = os.path.basename(patient_folder)
+    process_and_save_patient(patient_folder, str(tmp_path / 'out'), export_format='shards')
+
+    reader = ShardReader(str(tmp_path / 'out' / 'shards'))
+    series_folder = find_folder_with_max_files(patient_folder)
+    names = {entry['name']: entry['sop_uid'] for entry in index_scan(series_folder)}
+    assert len(reader) == len(names)
+
+    table = NoduleTable({patient: parse_columnar(find_xml_file(series_folder))})
+    rows = table.select(nodule_type=['N', 'NN'], inclusion=True)  # Small nodules get no box
+    labelled = 0
+    for i in range(len(reader)):
+        record, data = reader[i]
+        assert data[:2] == b'\xff\xd8'  # JPEG
+        label = record['label']
+        slice_rows = rows[table.columns['sop_uid'][rows] == names[record['file_name']]]
+        expected = {tuple(box) for box in zip(*(v.tolist() for v in yolo_boxes(table, slice_rows)))}
+        assert {tuple(box) for box in label['boxes']} == expected
+        assert label['cancerous'] == bool(len(table.select(nodule_type='N', sop_uids=names[record['file_name']])))
+        labelled += bool(label['boxes'])
+    reader.close()
+    assert labelled > 0
+
+def test_shards_rerun_when_annotations_change(tmp_path):
+    patient_folder, = make_dataset(str(tmp_path / 'data'), n_patients=1, n_slices=8, size=64, n_nodules=6)
+    output, manifest = str(tmp_path / 'out'), str(tmp_path / 'manifest.jsonl')
+    args = (str(tmp_path / 'data'), output, 1, None, None, None, manifest, 'shards')
+    assert len(run_patients(*args)[0]) == 1
+    assert run_patients(*args)[0] == []  # Up to date
+
+    with open(find_xml_file(find_folder_with_max_files(patient_folder)), 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?><LidcReadMessage xmlns="http://www.nih.gov" uid="1"/>')
+    assert len(run_patients(*args)[0]) == 1
+    reader = ShardReader(os.path.join(output, 'shards'))
+    assert all(not reader[i][0]['label']['boxes'] for i in range(len(reader)))
+    reader.close()
+
+def test_shard_rewrite_removes_stale_shards(tmp_path):
+    folder = str(tmp_path / 'shards')
+    scans = [(np.full((8, 8), i / 10), f"1-{i:03d}") for i in range(5)]
+    for prefix in ('LIDC-IDRI-0001', 'LIDC-IDRI-00010'):
+        with ShardWriter(folder, prefix=prefix, max_records=2) as writer:
+            for scan, name in scans:
+                writer.write(f"{prefix}_{name}", name.encode(), 'txt')
+    assert len(ShardReader(folder)) == 10
+
+    saved = save_patient_shards(scans[:3], folder, 'LIDC-IDRI-0001', value_range=(0, 1), num_threads=2, max_queued=2)
+    assert sorted(os.listdir(folder)) == sorted(saved + [f"LIDC-IDRI-00010-{i:06d}.{ext}" for i in range(3)
+                                                         for ext in ('tar', 'idx.json')])
+    records = [record['file_name'] for record in ShardReader(folder).records if record['ext'] == 'jpg']
+    assert records == [name for _, name in scans[:3]]
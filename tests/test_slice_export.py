@@ -0,0 +1,57 @@
+import os
+import sys
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ('Preprocessing', 'xml_parser', 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+from Preprocessing_steps import save_patient_jpgs, save_patient_pngs, EXPORT_HU_WINDOW
+from slice_export import save_raw_volume, load_raw_volume, uint16_to_hu
+
+#--------------------------------------------------------------------------------------------------------------
+
+def test_pooled_export_writes_the_serial_files(tmp_path):
+    volume = np.random.default_rng(0).random((12, 48, 40)).astype(np.float32)
+    combined_scans = [(scan, f"1-{i:03d}") for i, scan in enumerate(volume)]
+    outputs = {}
+    for num_threads in (1, 4):  # Serial loop, SliceExportPool
+        folder = str(tmp_path / f"threads_{num_threads}")
+        saved = save_patient_jpgs(combined_scans, folder, value_range=(0, 1), num_threads=num_threads)
+        outputs[num_threads] = {}
+        for name in saved:
+            with open(os.path.join(folder, name), 'rb') as f:
+                outputs[num_threads][name] = f.read()
+    assert sorted(os.listdir(tmp_path / 'threads_4')) == sorted(outputs[4]) == [f"1-{i:03d}.jpg" for i in range(12)]
+    assert outputs[4] == outputs[1]
+
+def integer_hu_volume(low=-1200, high=3200, shape=(5, 32, 24)):
+    # Integer HU values, partly outside EXPORT_HU_WINDOW to exercise the clipping
+    return np.random.default_rng(1).integers(low, high, shape).astype(np.float32)
+
+def test_png16_round_trip(tmp_path):
+    hu = integer_hu_volume()
+    combined_scans = [(scan, f"1-{i:03d}") for i, scan in enumerate(hu)]
+    saved = save_patient_pngs(combined_scans, str(tmp_path), EXPORT_HU_WINDOW, num_threads=2)
+    for (scan, _), name in zip(combined_scans, saved):
+        image = Image.open(tmp_path / name)
+        assert image.mode == 'I;16'
+        assert np.array_equal(uint16_to_hu(np.asarray(image, dtype=np.uint16), EXPORT_HU_WINDOW),
+                              np.clip(scan, *EXPORT_HU_WINDOW))
+
+def test_raw_round_trip(tmp_path):
+    hu = integer_hu_volume()
+    names = [f"1-{i:03d}" for i in range(len(hu))]
+    save_raw_volume(str(tmp_path / 'uint16'), hu, names, EXPORT_HU_WINDOW, 'uint16', spacing=[2.5, 0.7, 0.7])
+    volume, meta = load_raw_volume(str(tmp_path / 'uint16'))
+    assert isinstance(volume, np.memmap) and volume.dtype == np.uint16
+    assert meta['file_names'] == names and meta['spacing'] == [2.5, 0.7, 0.7]
+    assert np.array_equal(uint16_to_hu(volume, meta['window']), np.clip(hu, *EXPORT_HU_WINDOW))
+
+    # float16 is exact for integer HU below 2048
+    window = (-1024., 2047.)
+    save_raw_volume(str(tmp_path / 'float16'), hu, names, window, 'float16')
+    volume, meta = load_raw_volume(str(tmp_path / 'float16'))
+    assert volume.dtype == np.float16 and meta['scale'] == 1.
+    assert np.array_equal(volume.astype(np.float32), np.clip(hu, *window))
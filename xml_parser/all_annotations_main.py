@@ -7,8 +7,20 @@ import pydicom
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 from utils import create_folder, delete_folder, delete_files
+from sop_index import SopIndex
+from annotation_cache import load_annotations
+from instrumentation import Progress
+
+def run_annotations(patient_directory, cache_dir=None, num_workers=1):
+    """
+    Returns a dictionary patient -> [annotations, char_list]. With cache_dir the patients are
+    loaded by annotation_cache.load_annotations (in parallel, cached in cache_dir instead of CSV
+    files in the dataset) and converted with annotation.columns_to_frames.
+    """
+    if cache_dir is not None:
+        loaded = load_annotations(patient_directory, cache_dir, num_workers)
+        return {patient: list(ann.columns_to_frames(*columns)) for patient, columns in loaded.items()}
 
-def run_annotations(patient_directory):
     patients_dict = {}
     count = 0
     for folder in os.listdir(patient_directory):
@@ -31,10 +43,25 @@ def run_annotations(patient_directory):
 
 
 
-def bounding_box_create(dicom_directory, folder_name, pat_data):
+def as_tuple(value):
+    # ROI Centroid / ROI Rectangle: tuples from columns_to_frames, strings from the CSV files of parse_xml
+    if isinstance(value, tuple):
+        return value
+    if isinstance(value, str) and value not in ('nan', 'NA'):
+        return ast.literal_eval(value)
+    return None
+
+def bounding_box_create(dicom_directory, folder_name, pat_data, sop_index=None):
     pat_1 = pat_data[os.path.basename((dicom_directory))][0]
     dicom_dir = ann.find_folder_with_max_files(dicom_directory)
     output_dir = create_folder(dicom_directory,folder_name)
+    # Without a persistent SopIndex, index the series once in memory instead of walking it per row
+    if sop_index is None:
+        sop_index = SopIndex(':memory:')
+        sop_index.update(dicom_dir)
+    # Files of all the SOP-UIDs of the patient in one lookup
+    dicom_files = sop_index.lookup_many(pat_1['SOP-UID'].dropna().unique().tolist())
+    progress = Progress(f"Images of {os.path.basename(dicom_directory)}", len(pat_1))
     #Iterate thrpugh all the rows of the dataframe successfully removing nan rows
     for index, row in pat_1.iterrows():
         # Skip if both SOP-UIeD and Z-Coordinate are NaN
@@ -45,31 +72,20 @@ def bounding_box_create(dicom_directory, folder_name, pat_data):
         try:
             z_coordinate = float(row['Z-Coordinate']) if pd.notna(row['Z-Coordinate']) else None
             inclusion = row['Inclusion'] == True
-            roi_centroid = ast.literal_eval(row['ROI Centroid']) if pd.notna(row['ROI Centroid']) and row['ROI Centroid'] != 'nan' else None
-            roi_rectangle = ast.literal_eval(row['ROI Rectangle']) if pd.notna(row['ROI Rectangle']) and row['ROI Rectangle'] != 'nan' else None
+            roi_centroid = as_tuple(row['ROI Centroid'])
+            roi_rectangle = as_tuple(row['ROI Rectangle'])
             # print(roi_rectangle)    
             # print(f"Row {index} successfully parsed.")
         except (ValueError, SyntaxError):
             print(f"Skipping row {index} due to data parsing error.")
             continue
         # Load the DICOM file using the SOP-UID
-        dicom_file_path = None
-        for root, _, files in os.walk(dicom_dir):
-            for file in files:
-                if file.lower().endswith('.dcm'):
-                    dicom_path = os.path.join(root, file)
-                    dicom_data = pydicom.dcmread(dicom_path)
-
-                    # Check if the SOPInstanceUID matches
-                    if hasattr(dicom_data, 'SOPInstanceUID') and dicom_data.SOPInstanceUID == row['SOP-UID']:
-                        dicom_file_path = dicom_path
-                        break
-            if dicom_file_path:
-                break
+        dicom_file_path = dicom_files.get(row['SOP-UID'])
 
         if dicom_file_path is None:
             print(f"DICOM file with SOP-UID {row['SOP-UID']} not found.")
             continue
+        dicom_data = pydicom.dcmread(dicom_file_path)
         
         # Extract the image pixel array
         image = dicom_data.pixel_array
@@ -98,9 +114,9 @@ def bounding_box_create(dicom_directory, folder_name, pat_data):
         output_file = os.path.join(output_dir, f"SOP_UID_{row['SOP-UID']}.jpg")
         plt.savefig(output_file, format='jpg')
         plt.close(fig)
-
-        print(f"Saved image: {output_file}")
-        return None
+        progress.update(item=output_file)
+    progress.close()
+    return None
 #__main___
 # dicom_dir = '/home/aiims/tumor/xml_parsing/LIDC-IDRI/LIDC-IDRI-0138'
 # folder_name = 'images'
@@ -108,6 +124,10 @@ def bounding_box_create(dicom_directory, folder_name, pat_data):
 # pat_data = run_annotations(dirname)
 # print(pat_1.columns.to_list())
 # bounding_box_create(dicom_dir, folder_name, pat_data)
+# Or with a persistent index shared across patients
+# from sop_index import build_index
+# sop_index = build_index(dirname, "/home/aiims/tumor/xml_parsing/sop_index.sqlite")
+# bounding_box_create(dicom_dir, folder_name, pat_data, sop_index)
 
 # centroid_arr = (pat_data["LIDC-IDRI-0072"][0]["ROI Centroid"]).to_list()
 # print(centroid_arr)
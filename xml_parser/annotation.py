@@ -29,7 +29,7 @@ def parse_xml(dirname, use_pandas=True):
         dirname = find_folder_with_max_files(dirname)
         xml_file = find_xml_file(dirname)
         logging.info(f"XML file parsed: {xml_file}")
-        annotations, char_list = parse(xml_file)
+        annotations, char_list = columns_to_records(*parse_columnar(xml_file))
     if use_pandas and not os.path.isfile(output_file):
         logging.info(f"Saving annotations to file {output_file}")
         df = pd.DataFrame(annotations)  # Convert to DataFrame
@@ -90,13 +90,13 @@ def parse(xml_filename):
         NN = rad_annotation.non_nodules
         for i in range (len(N)):
             for j in range(len(N[i].rois)):
-                annotations.append({"Radiologist No.": radiologist_no, "Nodule Type": "N", "No.": i+1, "Nodule ID": N[i].id, "Inclusion": str(N[i].rois[j].inclusion) , "Z-Coordinate": N[i].rois[j].z, "SOP-UID": N[i].rois[j].sop_uid, "No. of ROI points": len(N[i].rois[j].roi_xy) , "List of ROI points": str(N[i].rois[j].roi_xy), "ROI Centroid": N[i].rois[j].roi_centroid, "ROI Rectangle": N[i].rois[j].roi_rect})
+                annotations.append({"Radiologist No.": radiologist_no, "Nodule Type": "N", "No.": i+1, "Nodule ID": N[i].id, "Inclusion": str(N[i].rois[j].inclusion) , "Z-Coordinate": N[i].rois[j].z, "SOP-UID": N[i].rois[j].sop_uid, "No. of ROI points": len(N[i].rois[j].roi_xy) , "List of ROI points": str(N[i].rois[j].roi_xy.tolist()), "ROI Centroid": N[i].rois[j].roi_centroid, "ROI Rectangle": N[i].rois[j].roi_rect})
         for i in range (len(S)):
             for j in range(len(S[i].rois)):
-                annotations.append({"Radiologist No.": radiologist_no, "Nodule Type": "S", "No.": i+1, "Nodule ID": S[i].id, "Inclusion": str(S[i].rois[j].inclusion) , "Z-Coordinate": S[i].rois[j].z, "SOP-UID": S[i].rois[j].sop_uid, "No. of ROI points": len(S[i].rois[j].roi_xy) , "List of ROI points": str(S[i].rois[j].roi_xy), "ROI Centroid": "NA", "ROI Rectangle": "NA"})
+                annotations.append({"Radiologist No.": radiologist_no, "Nodule Type": "S", "No.": i+1, "Nodule ID": S[i].id, "Inclusion": str(S[i].rois[j].inclusion) , "Z-Coordinate": S[i].rois[j].z, "SOP-UID": S[i].rois[j].sop_uid, "No. of ROI points": len(S[i].rois[j].roi_xy) , "List of ROI points": str(S[i].rois[j].roi_xy.tolist()), "ROI Centroid": "NA", "ROI Rectangle": "NA"})
         for i in range (len(NN)):
             for j in range(len(NN[i].rois)):
-                annotations.append({"Radiologist No.": radiologist_no, "Nodule Type": "NN","No.": i+1, "Nodule ID": NN[i].id, "Inclusion": str(NN[i].rois[j].inclusion) , "Z-Coordinate": NN[i].rois[j].z, "SOP-UID": NN[i].rois[j].sop_uid, "No. of ROI points": len(NN[i].rois[j].roi_xy) , "List of ROI points": str(NN[i].rois[j].roi_xy), "ROI Centroid": "NA", "ROI Rectangle": "NA"})
+                annotations.append({"Radiologist No.": radiologist_no, "Nodule Type": "NN","No.": i+1, "Nodule ID": NN[i].id, "Inclusion": str(NN[i].rois[j].inclusion) , "Z-Coordinate": NN[i].rois[j].z, "SOP-UID": NN[i].rois[j].sop_uid, "No. of ROI points": len(NN[i].rois[j].roi_xy) , "List of ROI points": str([tuple(p) for p in NN[i].rois[j].roi_xy.tolist()]), "ROI Centroid": "NA", "ROI Rectangle": "NA"})
         for i in range (len(N)):
             nodule_character_list.append({"Radiologist No.": radiologist_no, "Nodule Type": "N", "No.": i+1, "Nodule ID": N[i].id} | string_to_dict(N[i].characteristics.__str__()))
     return annotations, nodule_character_list
@@ -139,14 +139,14 @@ def parse_nodule(xml_node):  # xml_node is one unblindedReadNodule
         # 2.inside the nodule -> to indicate that the nodule has donut hole(the inside hole isnot part of the nodule) but by forcing inclusion to be TRUE, this situation is ignored
         roi.inclusion = (xml_roi.find('nih:inclusion', NS).text == "TRUE")
         edge_maps = xml_roi.findall('nih:edgeMap', NS)
+        roi_xy = []
         for edge_map in edge_maps:
             x = int(edge_map.find('nih:xCoord', NS).text)
             y = int(edge_map.find('nih:yCoord', NS).text)
-            roi.roi_xy.append([x, y])
-        xmax = np.array(roi.roi_xy)[:, 0].max()
-        xmin = np.array(roi.roi_xy)[:, 0].min()
-        ymax = np.array(roi.roi_xy)[:, 1].max()
-        ymin = np.array(roi.roi_xy)[:, 1].min()
+            roi_xy.append([x, y])
+        roi.roi_xy = roi_xy
+        xmin, ymin = roi.roi_xy.min(axis=0).tolist()
+        xmax, ymax = roi.roi_xy.max(axis=0).tolist()
         if not is_small:  # only for normalNodules
             roi.roi_rect = (xmin, ymin, xmax, ymax)
             roi.roi_centroid = (
@@ -163,13 +163,230 @@ def parse_non_nodule(xml_node):  # xml_node is one nonNodule
     roi.z = float(xml_node.find('nih:imageZposition', NS).text)
     roi.sop_uid = xml_node.find('nih:imageSOP_UID', NS).text
     loci = xml_node.findall('nih:locus', NS)
+    roi_xy = []
     for locus in loci:
         x = int(locus.find('nih:xCoord', NS).text)
         y = int(locus.find('nih:yCoord', NS).text)
-        roi.roi_xy.append((x, y))
+        roi_xy.append((x, y))
+    roi.roi_xy = roi_xy
     nodule.rois.append(roi)
     return nodule  # is equivalent to nonNodule(xml element)
 
+# Streaming parser
+# ------------------------------------------------------------------------------------------------------
+
+NS_PREFIX = '{' + NS['nih'] + '}'
+NODULE_TYPES = ('N', 'S', 'NN')  # Order of the nodule types in the output of parse
+CHARACTERISTICS = (  # XML tag, key of string_to_dict(NoduleCharacteristics.__str__())
+    ('subtlety', 'subtlty'), ('internalStructure', 'intstruct'), ('calcification', 'calci'),
+    ('sphericity', 'sphere'), ('margin', 'margin'), ('lobulation', 'lob'), ('spiculation', 'spicul'),
+    ('texture', 'txtur'), ('malignancy', 'malig'))
+
+def parse_columnar(xml_filename):
+    """
+    Single-pass alternative to parse using iterparse. Elements are cleared as soon as their nodule
+    is read, and the bounding boxes of all ROIs are computed in one vectorized pass over the
+    concatenated edge maps.
+
+    Returns:
+    - rois: Dictionary of NumPy arrays with one entry per ROI, in the order of parse:
+      'radiologist', 'nodule_type' ('N', 'S' or 'NN'), 'nodule_no', 'nodule_id', 'inclusion', 'z',
+      'sop_uid', 'n_points', 'xmin', 'ymin', 'xmax', 'ymax', 'cx', 'cy' (center of the bounding box),
+      plus the ROI points 'x' and 'y' of all ROIs concatenated, ROI i owning
+      x[point_offsets[i]:point_offsets[i + 1]].
+    - characteristics: Dictionary of NumPy arrays with one entry per normal nodule: 'radiologist',
+      'nodule_no', 'nodule_id' and the characteristics (keys as in parse's char_list).
+    """
+    logging.info(f"Parsing {xml_filename}")
+    tag = {name: NS_PREFIX + name for name in (
+        'xCoord', 'yCoord', 'edgeMap', 'locus', 'imageZposition', 'imageSOP_UID', 'inclusion', 'roi',
+        'noduleID', 'nonNoduleID', 'unblindedReadNodule', 'nonNodule', 'readingSession')}
+    X, Y, EDGE_MAP, LOCUS, ROI = tag['xCoord'], tag['yCoord'], tag['edgeMap'], tag['locus'], tag['roi']
+    char_keys = {NS_PREFIX + xml_tag: key for xml_tag, key in CHARACTERISTICS}
+
+    # One entry per ROI; the radiologist is assigned when its readingSession ends
+    radiologist, nodule_type, nodule_no, nodule_ids = [], [], [], []
+    inclusion, z, sop_uid, n_points = [], [], [], []
+    chars = {k: [] for k in ('radiologist', 'nodule_no', 'nodule_id')}
+    chars.update({key: [] for _, key in CHARACTERISTICS})
+    xs, ys = [], []
+
+    counts = dict.fromkeys(NODULE_TYPES, 0)  # Nodules of each type in the current reading session
+    session_start = (0, 0, 0)  # ROIs, points and characteristics before the current session
+    radiologist_no = 0
+    nodule_start = 0
+    nodule_chars = {}
+    nodule_id = None
+    roi = None  # [z, sop_uid, inclusion, n_points] of the current ROI
+    x = None
+
+    for _, elem in etree.iterparse(xml_filename):
+        t = elem.tag
+        if t == X:
+            x = elem.text
+        elif t == Y:
+            xs.append(x)
+            ys.append(elem.text)
+        elif t == EDGE_MAP or t == LOCUS:
+            if roi is None:
+                roi = [None, None, True, 0]
+            roi[3] += 1
+        elif t == ROI:
+            for column, value in zip((z, sop_uid, inclusion, n_points), roi):
+                column.append(value)
+            roi = None
+        elif t in char_keys:
+            nodule_chars[char_keys[t]] = int(elem.text)
+        elif t == tag['imageZposition'] or t == tag['imageSOP_UID'] or t == tag['inclusion']:
+            if roi is None:
+                roi = [None, None, True, 0]
+            if t == tag['imageZposition']:
+                roi[0] = float(elem.text)
+            elif t == tag['imageSOP_UID']:
+                roi[1] = elem.text
+            else:
+                # when inclusion = FALSE the roi is drawn around a hole of the nodule
+                roi[2] = (elem.text == "TRUE")
+        elif t == tag['noduleID'] or t == tag['nonNoduleID']:
+            nodule_id = elem.text
+        elif t == tag['unblindedReadNodule']:
+            # if no characteristics, it is a smallnodule
+            kind = 'N' if nodule_chars else 'S'
+            counts[kind] += 1
+            n_rois = len(z) - nodule_start
+            nodule_type += [kind] * n_rois
+            nodule_no += [counts[kind]] * n_rois
+            nodule_ids += [nodule_id] * n_rois
+            if kind == 'N':
+                chars['nodule_no'].append(counts['N'])
+                chars['nodule_id'].append(nodule_id)
+                for _, key in CHARACTERISTICS:
+                    chars[key].append(nodule_chars.get(key, 0))
+            nodule_start = len(z)
+            nodule_chars = {}
+            elem.clear()
+        elif t == tag['nonNodule']:
+            counts['NN'] += 1
+            for column, value in zip((z, sop_uid, inclusion, n_points, nodule_type, nodule_no, nodule_ids),
+                                     roi + ['NN', counts['NN'], nodule_id]):
+                column.append(value)
+            roi = None
+            nodule_start = len(z)
+            elem.clear()
+        elif t.endswith('eadingSession'):
+            if t == tag['readingSession']:
+                radiologist_no += 1
+                radiologist += [radiologist_no] * (len(z) - len(radiologist))
+                chars['radiologist'] += [radiologist_no] * (len(chars['nodule_id']) - len(chars['radiologist']))
+            else:
+                # Other sessions (CXRreadingSession) are not read by parse either
+                n_rois, n_pts, n_chars = session_start
+                for column in (nodule_type, nodule_no, nodule_ids, inclusion, z, sop_uid, n_points):
+                    del column[n_rois:]
+                del xs[n_pts:], ys[n_pts:]
+                for column in chars.values():
+                    del column[n_chars:]
+            session_start = (len(z), len(xs), len(chars['nodule_id']))
+            nodule_start = len(z)
+            counts = dict.fromkeys(NODULE_TYPES, 0)
+            elem.clear()
+
+    # Order the ROIs as parse does: per radiologist, normal, small, then non nodules
+    n_points = np.array(n_points, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(n_points)])
+    type_rank = np.array([NODULE_TYPES.index(k) for k in nodule_type], dtype=np.int64)
+    order = np.lexsort((np.array(nodule_no, dtype=np.int64), type_rank, np.array(radiologist, dtype=np.int64)))
+    n_points = n_points[order]
+    point_offsets = np.concatenate([[0], np.cumsum(n_points)])
+    point_index = np.repeat(offsets[:-1][order] - point_offsets[:-1], n_points) + np.arange(point_offsets[-1])
+    x = np.array(xs, dtype=np.int32)[point_index] if xs else np.zeros(0, dtype=np.int32)
+    y = np.array(ys, dtype=np.int32)[point_index] if ys else np.zeros(0, dtype=np.int32)
+
+    # Bounding boxes of all ROIs in one pass over the concatenated edge maps (every ROI has points)
+    starts = point_offsets[:-1]
+    has_points = n_points > 0
+    bounds = {}
+    for name, values, reduce in (('xmin', x, np.minimum), ('ymin', y, np.minimum),
+                                 ('xmax', x, np.maximum), ('ymax', y, np.maximum)):
+        bounds[name] = np.zeros(len(n_points), dtype=np.int32)
+        if has_points.any():
+            bounds[name][has_points] = reduce.reduceat(values, starts[has_points])
+
+    rois = {
+        'radiologist': np.array(radiologist, dtype=np.int16)[order],
+        'nodule_type': np.array(nodule_type, dtype='U2')[order],
+        'nodule_no': np.array(nodule_no, dtype=np.int32)[order],
+        'nodule_id': np.array(nodule_ids, dtype=object)[order],
+        'inclusion': np.array(inclusion, dtype=bool)[order],
+        'z': np.array(z, dtype=np.float64)[order],
+        'sop_uid': np.array(sop_uid, dtype=object)[order],
+        'n_points': n_points.astype(np.int32),
+    }
+    rois.update(bounds)
+    rois['cx'] = (rois['xmin'] + rois['xmax']) / 2
+    rois['cy'] = (rois['ymin'] + rois['ymax']) / 2
+    rois['point_offsets'] = point_offsets
+    rois['x'] = x
+    rois['y'] = y
+    characteristics = {k: np.array(v, dtype=object if k == 'nodule_id' else np.int16) for k, v in chars.items()}
+    return rois, characteristics
+
+# ------------------------------------------------------------------------------------------------------
+
+def columns_to_records(rois, characteristics):
+    """
+    Converts the output of parse_columnar to the (annotations, char_list) lists of dictionaries
+    returned by parse.
+    """
+    annotations = []
+    offsets = rois['point_offsets']
+    for i in range(len(rois['nodule_type'])):
+        nodule_type = str(rois['nodule_type'][i])
+        points = zip(rois['x'][offsets[i]:offsets[i + 1]].tolist(), rois['y'][offsets[i]:offsets[i + 1]].tolist())
+        # Non nodule loci are tuples, edge map points are lists
+        points = [p for p in points] if nodule_type == 'NN' else [list(p) for p in points]
+        is_normal = nodule_type == 'N'
+        annotations.append({"Radiologist No.": int(rois['radiologist'][i]), "Nodule Type": nodule_type,
+                            "No.": int(rois['nodule_no'][i]), "Nodule ID": rois['nodule_id'][i],
+                            "Inclusion": str(bool(rois['inclusion'][i])), "Z-Coordinate": float(rois['z'][i]),
+                            "SOP-UID": rois['sop_uid'][i], "No. of ROI points": int(rois['n_points'][i]),
+                            "List of ROI points": str(points),
+                            "ROI Centroid": (float(rois['cx'][i]), float(rois['cy'][i])) if is_normal else "NA",
+                            "ROI Rectangle": (int(rois['xmin'][i]), int(rois['ymin'][i]), int(rois['xmax'][i]),
+                                              int(rois['ymax'][i])) if is_normal else "NA"})
+    char_list = []
+    for i in range(len(characteristics['nodule_id'])):
+        record = {"Radiologist No.": int(characteristics['radiologist'][i]), "Nodule Type": "N",
+                  "No.": int(characteristics['nodule_no'][i]), "Nodule ID": characteristics['nodule_id'][i]}
+        record.update({key: int(characteristics[key][i]) for _, key in CHARACTERISTICS})
+        char_list.append(record)
+    return annotations, char_list
+
+def columns_to_frames(rois, characteristics):
+    """
+    Converts the output of parse_columnar to (annotations, char_list) DataFrames with the columns of
+    parse. Unlike the CSV files of parse_xml the values stay native: 'List of ROI points' holds
+    (n, 2) int32 arrays, 'ROI Centroid' and 'ROI Rectangle' tuples for normal nodules (None otherwise).
+    """
+    is_normal = rois['nodule_type'] == 'N'
+    offsets = rois['point_offsets']
+    points = np.stack([rois['x'], rois['y']], axis=1)
+    centroids = np.empty(len(is_normal), dtype=object)
+    rectangles = np.empty(len(is_normal), dtype=object)
+    for i in np.flatnonzero(is_normal):
+        centroids[i] = (float(rois['cx'][i]), float(rois['cy'][i]))
+        rectangles[i] = (int(rois['xmin'][i]), int(rois['ymin'][i]), int(rois['xmax'][i]), int(rois['ymax'][i]))
+    annotations = pd.DataFrame({
+        "Radiologist No.": rois['radiologist'], "Nodule Type": rois['nodule_type'].astype(object),
+        "No.": rois['nodule_no'], "Nodule ID": rois['nodule_id'], "Inclusion": rois['inclusion'],
+        "Z-Coordinate": rois['z'], "SOP-UID": rois['sop_uid'], "No. of ROI points": rois['n_points'],
+        "List of ROI points": [points[offsets[i]:offsets[i + 1]] for i in range(len(is_normal))],
+        "ROI Centroid": centroids, "ROI Rectangle": rectangles})
+    char_list = pd.DataFrame({"Radiologist No.": characteristics['radiologist'], "Nodule Type": "N",
+                              "No.": characteristics['nodule_no'], "Nodule ID": characteristics['nodule_id']}
+                             | {key: characteristics[key] for _, key in CHARACTERISTICS})
+    return annotations, char_list
+
 # ------------------------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------------------------
 
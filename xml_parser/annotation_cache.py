@@ -0,0 +1,104 @@
+import os
+import numpy as np
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from annotation import find_xml_file, parse_columnar
+from utils import find_folder_with_max_files
+from instrumentation import Progress, active, collect, stage
+
+# Central cache of parsed annotations: one <patient>.npz per patient in a cache folder outside the dataset,
+# holding the columns of parse_columnar (ROI points as int32 arrays) and the path, mtime and size of the XML
+# file they were parsed from. An entry is re-parsed when the XML file changes.
+
+STRING_COLUMNS = ('nodule_id', 'sop_uid')  # Stored as fixed-width unicode, loaded as object arrays
+
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+
+def _xml_stamp(xml_file):
+    st = os.stat(xml_file)
+    return np.array([xml_file]), np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+# ------------------------------------------------------------------------------------------------------
+
+def _to_columns(npz, prefix):
+    columns = {}
+    for name in npz.files:
+        if name.startswith(prefix):
+            column = npz[name]
+            key = name[len(prefix):]
+            columns[key] = column.astype(object) if key in STRING_COLUMNS else column
+    return columns
+
+# ------------------------------------------------------------------------------------------------------
+
+def load_patient(patient_folder, cache_dir):
+    """
+    Returns the (rois, characteristics) columns of parse_columnar for one patient, from
+    cache_dir/<patient>.npz when it was parsed from the current XML file, parsing and caching
+    them otherwise. Returns None if the patient has no single XML file.
+    """
+    patient = os.path.basename(os.path.normpath(patient_folder))
+    cache_file = os.path.join(cache_dir, f"{patient}.npz")
+    xml_file = find_xml_file(find_folder_with_max_files(patient_folder))
+    if not xml_file:
+        return None
+    xml_path, stamp = _xml_stamp(xml_file)
+
+    if os.path.isfile(cache_file):
+        with stage('annotation_cache_load', patient), np.load(cache_file) as npz:
+            if npz['xml_path'][0] == xml_path[0] and np.array_equal(npz['xml_stamp'], stamp):
+                return _to_columns(npz, 'roi_'), _to_columns(npz, 'char_')
+
+    with stage('parse_xml', patient):
+        rois, characteristics = parse_columnar(xml_file)
+    arrays = {'xml_path': xml_path, 'xml_stamp': stamp}
+    for prefix, columns in (('roi_', rois), ('char_', characteristics)):
+        for key, column in columns.items():
+            arrays[prefix + key] = column.astype(str) if key in STRING_COLUMNS else column
+    tmp = os.path.join(cache_dir, f".{patient}.{os.getpid()}.npz")
+    with stage('annotation_cache_save', patient):
+        np.savez(tmp, **arrays)
+        os.replace(tmp, cache_file)
+    return rois, characteristics
+
+# ------------------------------------------------------------------------------------------------------
+
+def _load_patient_safe(args):
+    # Also returns the stage records of the patient, which are lost in a worker process otherwise
+    patient_folder, cache_dir = args
+    with collect() as stats:
+        try:
+            return load_patient(patient_folder, cache_dir), None, stats.records
+        except Exception as e:
+            return None, str(e), stats.records
+
+# ------------------------------------------------------------------------------------------------------
+
+def load_annotations(patient_directory, cache_dir, num_workers=None):
+    """
+    Loads the annotations of every patient folder of patient_directory, parsing the patients whose
+    XML changed on num_workers processes (defaults to os.cpu_count(), 1 loads serially).
+
+    Returns:
+    - Dictionary patient -> (rois, characteristics) as returned by parse_columnar.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    patients = sorted(p for p in os.listdir(patient_directory)
+                      if os.path.isdir(os.path.join(patient_directory, p)))
+    jobs = [(os.path.join(patient_directory, p), cache_dir) for p in patients]
+    num_workers = num_workers or os.cpu_count() or 1
+    stats = active()
+    patients_dict = {}
+    with Progress("Annotations", len(jobs)) as progress, \
+            ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else nullcontext() as executor:
+        loaded = executor.map(_load_patient_safe, jobs, chunksize=8) if executor else map(_load_patient_safe, jobs)
+        for patient, (columns, error, records) in zip(patients, loaded):
+            if stats is not None:
+                stats.extend(records)
+            if error is not None:
+                print(f"Error loading {patient}: {error}")
+            elif columns is not None:
+                patients_dict[patient] = columns
+            progress.update(item=patient)
+    return patients_dict
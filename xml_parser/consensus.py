@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+# Consensus of the (up to four) radiologist readings of a NoduleTable.
+# ROIs of different radiologists on the same slice are linked when they are of the same nodule type and their
+# centers are within max_distance pixels (and their boxes overlap by at least min_iou), so the rectangles of
+# normal nodules are never averaged with the single points of small or non nodules and the readers of a cluster
+# agree on the type. The ROIs of one radiologist's nodule are linked across slices. Connected components of the
+# links on one slice are the slice clusters, components of all links are the 3D nodules. Candidate pairs come
+# from one KD-tree query over all slices at once: every slice is moved to its own region of the plane, far
+# enough apart that no pair crosses slices.
+
+SLICE_OFFSET = 1e5  # Distance between the slice regions, larger than any image plus max_distance
+
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+
+def _components(n, pairs):
+    # Component label of each of n nodes linked by the (m, 2) array pairs
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+# ------------------------------------------------------------------------------------------------------
+
+def _iou(c, i, j):
+    # Intersection over union of the ROI rectangles of rows i and j (pixel boxes, bounds inclusive)
+    w = np.minimum(c['xmax'][i], c['xmax'][j]) - np.maximum(c['xmin'][i], c['xmin'][j]) + 1
+    h = np.minimum(c['ymax'][i], c['ymax'][j]) - np.maximum(c['ymin'][i], c['ymin'][j]) + 1
+    inter = np.clip(w, 0, None) * np.clip(h, 0, None)
+    area_i = (c['xmax'][i] - c['xmin'][i] + 1) * (c['ymax'][i] - c['ymin'][i] + 1)
+    area_j = (c['xmax'][j] - c['xmin'][j] + 1) * (c['ymax'][j] - c['ymin'][j] + 1)
+    return inter / (area_i + area_j - inter)
+
+# ------------------------------------------------------------------------------------------------------
+
+def reading_key(table, rows):
+    # One integer per nodule of one radiologist: (patient, radiologist, nodule type, nodule number)
+    return (table.patient.codes[rows] << 40) | (table.columns['radiologist'][rows].astype(np.int64) << 24) \
+        | (table.type_codes[rows].astype(np.int64) << 20) | table.columns['nodule_no'][rows].astype(np.int64)
+
+# ------------------------------------------------------------------------------------------------------
+
+def cluster_rois(table, rows=None, max_distance=10., min_iou=0.):
+    """
+    Clusters ROIs of the same nodule type of different radiologists on the same slice and links
+    them into 3D nodules.
+
+    Parameters:
+    - table: NoduleTable.
+    - rows: Rows to cluster, by default the inclusion ROIs of normal and small nodules.
+    - max_distance: Maximum distance of the centers of two linked ROIs, in pixels.
+    - min_iou: Minimum overlap of the rectangles of two linked ROIs.
+
+    Returns:
+    - (rows, slice_cluster, nodule_cluster): cluster numbers of every row.
+    """
+    if rows is None:
+        rows = table.select(nodule_type=['N', 'S'], inclusion=True)
+    rows = np.asarray(rows, dtype=np.int64)
+    c = table.columns
+    n = len(rows)
+    if n == 0:
+        return rows, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Candidate pairs on the same slice from one KD-tree over the offset slice regions
+    slice_codes = table.sop_uid.codes[rows]
+    coords = np.stack([c['cx'][rows] + slice_codes * SLICE_OFFSET, c['cy'][rows]], axis=1)
+    pairs = cKDTree(coords).query_pairs(max_distance, output_type='ndarray')
+    radiologist = c['radiologist'][rows]
+    types = table.type_codes[rows]
+    keep = (radiologist[pairs[:, 0]] != radiologist[pairs[:, 1]]) & (types[pairs[:, 0]] == types[pairs[:, 1]])
+    if min_iou > 0:
+        keep &= _iou(c, rows[pairs[:, 0]], rows[pairs[:, 1]]) >= min_iou
+    pairs = pairs[keep]
+    slice_cluster = _components(n, pairs)
+
+    # 3D: also link consecutive ROIs of the same nodule of one radiologist
+    readings = reading_key(table, rows)
+    order = np.argsort(readings, kind='stable')
+    same = readings[order][1:] == readings[order][:-1]
+    reader_links = np.stack([order[:-1][same], order[1:][same]], axis=1)
+    nodule_cluster = _components(n, np.concatenate([pairs, reader_links]))
+    return rows, slice_cluster, nodule_cluster
+
+# ------------------------------------------------------------------------------------------------------
+
+def consensus(table, rows=None, max_distance=10., min_iou=0.):
+    """
+    Merges the readings of the radiologists (see cluster_rois for the parameters).
+
+    Returns:
+    - slices: DataFrame with one merged box per slice cluster: 'Patient', 'SOP-UID',
+      'Z-Coordinate', 'Nodule' (3D cluster), the mean box 'xmin', 'ymin', 'xmax', 'ymax', 'cx',
+      'cy', 'Readers' (number of radiologists agreeing) and 'Mean malignancy' (of the normal
+      nodule readings, NaN if there is none).
+    - nodules: DataFrame with one row per 3D cluster: 'Patient', 'Nodule', 'Readers', 'Mean
+      malignancy' (one rating per radiologist nodule), 'Slices', 'Z min' and 'Z max'.
+    """
+    rows, slice_cluster, nodule_cluster = cluster_rois(table, rows, max_distance, min_iou)
+    c = table.columns
+    malig = c['malig'][rows].astype(np.float64)
+    malig[malig == 0] = np.nan  # Small nodules have no rating
+    df = pd.DataFrame({
+        'Patient': table.patient.categories[table.patient.codes[rows]].astype(object),
+        'SOP-UID': c['sop_uid'][rows], 'Z-Coordinate': c['z'][rows],
+        'Nodule': nodule_cluster, 'Slice cluster': slice_cluster, 'Radiologist': c['radiologist'][rows],
+        'Reading': reading_key(table, rows),
+        'xmin': c['xmin'][rows], 'ymin': c['ymin'][rows], 'xmax': c['xmax'][rows], 'ymax': c['ymax'][rows],
+        'cx': c['cx'][rows], 'cy': c['cy'][rows], 'malig': malig})
+
+    slices = df.groupby('Slice cluster', sort=True).agg(
+        **{'Patient': ('Patient', 'first'), 'SOP-UID': ('SOP-UID', 'first'),
+           'Z-Coordinate': ('Z-Coordinate', 'first'), 'Nodule': ('Nodule', 'first'),
+           'xmin': ('xmin', 'mean'), 'ymin': ('ymin', 'mean'), 'xmax': ('xmax', 'mean'), 'ymax': ('ymax', 'mean'),
+           'cx': ('cx', 'mean'), 'cy': ('cy', 'mean'), 'Readers': ('Radiologist', 'nunique'),
+           'Mean malignancy': ('malig', 'mean')}).reset_index(drop=True)
+
+    readings = df.drop_duplicates('Reading')
+    nodules = readings.groupby('Nodule', sort=True).agg(
+        **{'Patient': ('Patient', 'first'), 'Readers': ('Radiologist', 'nunique'),
+           'Mean malignancy': ('malig', 'mean')})
+    extent = df.groupby('Nodule', sort=True).agg(
+        **{'Slices': ('SOP-UID', 'nunique'), 'Z min': ('Z-Coordinate', 'min'), 'Z max': ('Z-Coordinate', 'max')})
+    nodules = nodules.join(extent).reset_index()
+    return slices, nodules
@@ -0,0 +1,200 @@
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+# Per-stage accounting of the pipeline runs. Code wraps its stages in stage(name); while a RunStats is active
+# (see collect) every stage appends one record with the patient, the wall time, the bytes the process read and
+# wrote in the meantime (rchar / wchar of /proc/self/io: page cache hits included, memory-mapped I/O not)
+# and the peak RSS of the process so far. Without an active RunStats a stage costs a single check. Worker
+# processes collect their own records and return them to the parent, which merges them with RunStats.extend.
+# Progress replaces per-file prints with at most one line every PROGRESS_INTERVAL seconds.
+
+PROGRESS_INTERVAL = 5.0  # Seconds between two progress lines
+RECORD_FIELDS = ('patient', 'stage', 'wall_s', 'bytes_read', 'bytes_written', 'peak_rss_bytes')
+
+_active = None  # RunStats the stages are recorded into
+_patient = None  # Patient the stages are attributed to
+
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+
+def io_counters():
+    # (bytes read, bytes written) by the process so far, (0, 0) where /proc/self/io is not available
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+# ------------------------------------------------------------------------------------------------------
+
+def peak_rss():
+    # Peak resident set size of the process in bytes (ru_maxrss is in KiB on Linux, in bytes on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+# ------------------------------------------------------------------------------------------------------
+
+class RunStats:
+    def __init__(self):
+        self.records = []
+        self.started = time.strftime('%Y-%m-%d %H:%M:%S')
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, stage, wall_s, bytes_read=0, bytes_written=0, patient=None, peak_rss_bytes=None):
+        record = {'patient': patient, 'stage': stage, 'wall_s': wall_s, 'bytes_read': bytes_read,
+                  'bytes_written': bytes_written, 'peak_rss_bytes': peak_rss_bytes}
+        with self._lock:
+            self.records.append(record)
+
+    def extend(self, records):
+        # Merges the records of another RunStats, e.g. returned by a worker process
+        with self._lock:
+            self.records.extend(records)
+
+    def frame(self):
+        return pd.DataFrame(self.records, columns=list(RECORD_FIELDS))
+
+    def summary(self):
+        """
+        Returns a DataFrame with one row per stage (in order of first appearance): number of calls
+        and patients, total and mean wall time, share of the total stage time, bytes read and
+        written, and the largest peak RSS. The time of a stage run inside another stage is counted
+        in both.
+        """
+        df = self.frame()
+        summary = df.groupby('stage', sort=False).agg(
+            calls=('wall_s', 'size'), patients=('patient', 'nunique'), wall_s=('wall_s', 'sum'),
+            mean_s=('wall_s', 'mean'), bytes_read=('bytes_read', 'sum'), bytes_written=('bytes_written', 'sum'),
+            peak_rss_bytes=('peak_rss_bytes', 'max'))
+        total = summary['wall_s'].sum()
+        summary.insert(4, 'share', summary['wall_s'] / total if total > 0 else 0.)
+        return summary
+
+    def summary_table(self):
+        # Summary as text, with times in seconds and sizes in MiB
+        summary = self.summary()
+        table = pd.DataFrame({
+            'calls': summary['calls'], 'patients': summary['patients'], 'total s': summary['wall_s'].round(2),
+            'mean s': summary['mean_s'].round(3), 'share': (100 * summary['share']).round(1).astype(str) + '%',
+            'read MiB': (summary['bytes_read'] / 2 ** 20).round(1),
+            'written MiB': (summary['bytes_written'] / 2 ** 20).round(1),
+            'peak RSS MiB': (summary['peak_rss_bytes'] / 2 ** 20).round(0),
+        })
+        return table.to_string()
+
+    def report(self, path=None, **extra):
+        """
+        Returns the run as a JSON-serializable dictionary: start time, wall time, peak RSS, the
+        summary per stage and the records per patient and stage. Written to path if given; extra
+        keys (e.g. parameters of the run) are added as they are.
+        """
+        summary = self.summary()
+        records = self.frame()
+        peak = max([peak_rss()] + [r for r in records['peak_rss_bytes'] if pd.notna(r)])
+        patients = {}
+        for record in records[records['patient'].notna()].to_dict('records'):
+            stages = patients.setdefault(record['patient'], {})
+            totals = stages.setdefault(record['stage'], {'wall_s': 0., 'bytes_read': 0, 'bytes_written': 0})
+            for key in totals:
+                totals[key] += record[key]
+        report = {
+            'started': self.started,
+            'wall_s': time.perf_counter() - self._start,
+            'peak_rss_bytes': int(peak),
+            'stages': json.loads(summary.to_json(orient='index')),
+            'patients': json.loads(json.dumps(patients, default=int)),
+        }
+        report.update(extra)
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+# ------------------------------------------------------------------------------------------------------
+
+@contextmanager
+def collect(stats=None, patient=None):
+    """
+    Records the stages run in the block into stats (a new RunStats by default), attributed to
+    patient, and yields stats. The previously active RunStats is restored on exit.
+    """
+    global _active, _patient
+    previous = _active, _patient
+    _active = stats if stats is not None else RunStats()
+    _patient = patient
+    try:
+        yield _active
+    finally:
+        _active, _patient = previous
+
+# ------------------------------------------------------------------------------------------------------
+
+def active():
+    # The RunStats stages are currently recorded into, or None
+    return _active
+
+# ------------------------------------------------------------------------------------------------------
+
+@contextmanager
+def stage(name, patient=None):
+    # Records the wall time, I/O and peak RSS of the block as stage name of the active RunStats, if any
+    stats = _active
+    if stats is None:
+        yield
+        return
+    read, written = io_counters()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_s = time.perf_counter() - start
+        read_end, written_end = io_counters()
+        stats.add(name, wall_s, read_end - read, written_end - written, patient or _patient, peak_rss())
+
+# ------------------------------------------------------------------------------------------------------
+
+class Progress:
+    def __init__(self, label, total=None, interval=PROGRESS_INTERVAL):
+        """
+        Rate-limited progress output: update() prints a line with the count, rate and estimated
+        time left at most every interval seconds, close() prints the final count.
+        """
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self._start = self._last = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _line(self, now):
+        elapsed = now - self._start
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        line = f"{self.label}: {self.done}"
+        if self.total:
+            line += f"/{self.total} ({100 * self.done / self.total:.0f}%)"
+        line += f", {rate:.1f}/s, {elapsed:.0f} s"
+        if self.total and rate > 0 and self.done < self.total:
+            line += f", about {(self.total - self.done) / rate:.0f} s left"
+        return line
+
+    def update(self, n=1, item=None):
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            print(self._line(now) + (f" ({item})" if item is not None else ""), flush=True)
+
+    def close(self):
+        print(self._line(time.perf_counter()), flush=True)
@@ -1,3 +1,10 @@
+import numpy as np
+
+# Nodule structures use __slots__ (no per-object __dict__), ROI points are stored as (n, 2) int16 arrays and
+# characteristics as 9 uint8 values, so a whole dataset of parsed annotations stays small in memory.
+
+ROI_DTYPE = np.int16  # LIDC coordinates are pixel indices of 512x512 slices
+
 # ------------------------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------------------------
 
@@ -91,16 +98,27 @@ class IdriReadMessage:
 # ------------------------------------------------------------------------------------------------------
 
 class NoduleRoi:  # is common for nodule and non-nodule
+    __slots__ = ('z', 'sop_uid', 'inclusion', '_roi_xy', 'roi_rect', 'roi_centroid')
+
     def __init__(self, z_pos=0., sop_uid=''):
         self.z = z_pos
         self.sop_uid = sop_uid
         self.inclusion = True
 
-        self.roi_xy = []  # to hold list of x,ycords in edgemap(edgmap pairs)
+        self.roi_xy = ()  # to hold x,ycords in edgemap(edgmap pairs) as an (n, 2) array
         self.roi_rect = []  # rectangle to hold the roi
         self.roi_centroid = []  # to hold centroid of the roi
         return
 
+    @property
+    def roi_xy(self):
+        return self._roi_xy
+
+    @roi_xy.setter
+    def roi_xy(self, points):
+        # Accepts a list of [x, y] pairs or an array, stored as an (n, 2) ROI_DTYPE array
+        self._roi_xy = np.asarray(points, dtype=ROI_DTYPE).reshape(-1, 2)
+
     def __str__(self):
         n_pts = len(self.roi_xy)
         str = f"Inclusion {self.inclusion} Z = {self.z} SOP_UID {self.sop_uid} \n ROI points {n_pts}  ::  " 
@@ -123,6 +141,8 @@ class NoduleRoi:  # is common for nodule and non-nodule
 # ------------------------------------------------------------------------------------------------------
 
 class Nodule:  # is base class for all nodule types (NormalNodule, SmallNodule and NonNodule)
+    __slots__ = ('id', 'rois', 'is_small')
+
     def __init__(self):
         self.id = None
         self.rois = []
@@ -141,26 +161,37 @@ class Nodule:  # is base class for all nodule types (NormalNodule, SmallNodule a
 
 # Defined only for Normal Nodules' characteristics assignment
 class NoduleCharacteristics:
+    FIELDS = ('subtlety', 'internal_struct', 'calcification', 'sphericity', 'margin', 'lobulation',
+              'spiculation', 'texture', 'malignancy')
+    DTYPE = np.dtype([(field, np.uint8) for field in FIELDS])  # Ratings are 1-6
+    __slots__ = ('_values',)
+
     def __init__(self):
-        self.subtlety = 0
-        self.internal_struct = 0
-        self.calcification = 0
-        self.sphericity = 0
-        self.margin = 0
-        self.lobulation = 0
-        self.spiculation = 0
-        self.texture = 0
-        self.malignancy = 0
+        self._values = np.zeros((), dtype=self.DTYPE)
         return
 
+    def to_record(self):
+        # Copy of the ratings as a DTYPE record, e.g. to fill a structured array of all nodules
+        return self._values.copy()
+
     def __str__(self):
         str = f"subtlty: {self.subtlety}, intstruct: {self.internal_struct}, calci: {self.calcification}, sphere: {self.sphericity}, margin: {self.margin}, lob: {self.lobulation}, spicul: {self.spiculation}, txtur: {self.texture}, malig: {self.malignancy}"
         return str
     
+def _rating(field):
+    return property(lambda self: int(self._values[field]),
+                    lambda self, value: self._values.__setitem__(field, value))
+
+for _field in NoduleCharacteristics.FIELDS:
+    setattr(NoduleCharacteristics, _field, _rating(_field))
+del _field
+
 # ------------------------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------------------------
 
 class NormalNodule(Nodule):
+    __slots__ = ('characteristics',)
+
     def __init__(self):
         Nodule.__init__(self)
         self.characteristics = NoduleCharacteristics()
@@ -179,6 +210,8 @@ class NormalNodule(Nodule):
 # ------------------------------------------------------------------------------------------------------
 
 class SmallNodule(Nodule):
+    __slots__ = ()
+
     def __init__(self):
         Nodule.__init__(self)
         self.is_small = True
@@ -193,6 +226,8 @@ class SmallNodule(Nodule):
 # ------------------------------------------------------------------------------------------------------
 
 class NonNodule(Nodule):
+    __slots__ = ()
+
     def __init__(self):
         Nodule.__init__(self)
         self.is_small = True
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+from annotation import CHARACTERISTICS, NODULE_TYPES
+from annotation_cache import load_annotations
+
+# Dataset-wide table of all ROIs of all patients, built from the columns of parse_columnar.
+# Every ROI is one row; the characteristics of its normal nodule are joined onto it once (0 for small and
+# non nodules). SOP-UIDs and patients are stored as integer codes with sorted row indexes, so filters and
+# joins are array operations instead of repeated DataFrame scans.
+
+CHARACTERISTIC_KEYS = tuple(key for _, key in CHARACTERISTICS)
+
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+
+class _CodeIndex:
+    # Sorted categories of a string column, the code of every row and the rows grouped by code
+    def __init__(self, values):
+        self.categories, self.codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        self.codes = self.codes.astype(np.int64)
+        self.order = np.argsort(self.codes, kind='stable')
+        self.starts = np.searchsorted(self.codes[self.order], np.arange(len(self.categories) + 1))
+
+    def lookup(self, values):
+        # Codes of values, -1 for values not in the column
+        values = np.asarray(values, dtype=str).reshape(-1)
+        pos = np.searchsorted(self.categories, values)
+        pos[pos == len(self.categories)] = 0
+        found = self.categories[pos] == values if len(self.categories) else np.zeros(len(values), dtype=bool)
+        return np.where(found, pos, -1)
+
+    def rows(self, values):
+        # Rows whose value is one of values, in row order
+        codes = self.lookup(values)
+        codes = codes[codes >= 0]
+        return np.sort(np.concatenate([self.order[self.starts[c]:self.starts[c + 1]] for c in codes]
+                                      or [np.zeros(0, dtype=np.int64)]))
+
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+
+class NoduleTable:
+    def __init__(self, patients_dict):
+        """
+        Parameters:
+        - patients_dict: Dictionary patient -> (rois, characteristics) as returned by
+          annotation_cache.load_annotations (or parse_columnar per patient).
+        """
+        patients = sorted(patients_dict)
+        rois = [patients_dict[p][0] for p in patients]
+        chars = [patients_dict[p][1] for p in patients]
+        n_rois = np.array([len(r['z']) for r in rois], dtype=np.int64)
+
+        columns = {}
+        for key in ('radiologist', 'nodule_type', 'nodule_no', 'nodule_id', 'inclusion', 'z', 'sop_uid',
+                    'n_points', 'xmin', 'ymin', 'xmax', 'ymax', 'cx', 'cy', 'x', 'y'):
+            columns[key] = np.concatenate([r[key] for r in rois]) if rois else np.zeros(0)
+        n_points = columns['n_points'].astype(np.int64)
+        columns['point_offsets'] = np.concatenate([[0], np.cumsum(n_points)])
+        self.columns = columns
+        self.patient = _CodeIndex(np.repeat(np.array(patients, dtype=str), n_rois))
+        self.sop_uid = _CodeIndex(columns['sop_uid'])
+        self.type_codes = np.select([columns['nodule_type'] == t for t in NODULE_TYPES],
+                                    np.arange(len(NODULE_TYPES)), -1).astype(np.int8)
+
+        # Join the characteristics of the normal nodules: key (patient, radiologist, nodule number)
+        n_chars = np.array([len(c['nodule_no']) for c in chars], dtype=np.int64)
+        char_patient = np.repeat(np.arange(len(patients)), n_chars)
+        char_columns = {key: np.concatenate([c[key] for c in chars]).astype(np.int64) if chars else np.zeros(0)
+                        for key in ('radiologist', 'nodule_no') + CHARACTERISTIC_KEYS}
+        char_key = self._nodule_key(char_patient, char_columns['radiologist'], char_columns['nodule_no'])
+        roi_key = self._nodule_key(np.repeat(np.arange(len(patients)), n_rois), columns['radiologist'],
+                                   columns['nodule_no'])
+        order = np.argsort(char_key)
+        pos = np.searchsorted(char_key[order], roi_key)
+        pos[pos == len(order)] = 0
+        matched = (self.type_codes == NODULE_TYPES.index('N'))
+        if len(order):
+            matched &= char_key[order][pos] == roi_key
+        else:
+            matched[:] = False
+        for key in CHARACTERISTIC_KEYS:
+            values = np.zeros(len(roi_key), dtype=np.int16)
+            if len(order):
+                values[matched] = char_columns[key][order][pos[matched]]
+            columns[key] = values
+
+    @staticmethod
+    def _nodule_key(patient_codes, radiologist, nodule_no):
+        return (np.asarray(patient_codes, dtype=np.int64) << 40) | (np.asarray(radiologist, dtype=np.int64) << 20) \
+            | np.asarray(nodule_no, dtype=np.int64)
+
+    @classmethod
+    def load(cls, patient_directory, cache_dir, num_workers=None):
+        # Table of every patient of patient_directory, read through the annotation cache
+        return cls(load_annotations(patient_directory, cache_dir, num_workers))
+
+    def __len__(self):
+        return len(self.columns['z'])
+
+    def patients(self):
+        return self.patient.categories.tolist()
+
+    def points(self, row):
+        # (n, 2) array of the ROI points of row
+        start, stop = self.columns['point_offsets'][row], self.columns['point_offsets'][row + 1]
+        return np.stack([self.columns['x'][start:stop], self.columns['y'][start:stop]], axis=1)
+
+    def select(self, nodule_type=None, patients=None, sop_uids=None, min_malignancy=None, inclusion=None):
+        """
+        Returns the rows (ascending) matching all given filters:
+        - nodule_type: 'N', 'S', 'NN' or a list of them.
+        - patients, sop_uids: Lists of patients or SOP-UIDs, looked up through the indexes.
+        - min_malignancy: Minimum malignancy rating (selects normal nodules only).
+        - inclusion: True or False.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if nodule_type is not None:
+            types = [nodule_type] if isinstance(nodule_type, str) else nodule_type
+            mask &= np.isin(self.type_codes, [NODULE_TYPES.index(t) for t in types])
+        if patients is not None:
+            mask &= self._row_mask(self.patient, [patients] if isinstance(patients, str) else patients)
+        if sop_uids is not None:
+            mask &= self._row_mask(self.sop_uid, [sop_uids] if isinstance(sop_uids, str) else sop_uids)
+        if min_malignancy is not None:
+            mask &= self.columns['malig'] >= min_malignancy
+        if inclusion is not None:
+            mask &= self.columns['inclusion'] == inclusion
+        return np.flatnonzero(mask)
+
+    def _row_mask(self, index, values):
+        mask = np.zeros(len(self), dtype=bool)
+        mask[index.rows(values)] = True
+        return mask
+
+    def by_slice(self, rows=None):
+        """
+        Groups rows by SOP-UID.
+
+        Returns:
+        - (sop_uids, offsets, rows): rows sorted by slice, the rows of sop_uids[i] being
+          rows[offsets[i]:offsets[i + 1]].
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        codes = self.sop_uid.codes[rows]
+        order = np.argsort(codes, kind='stable')
+        rows, codes = rows[order], codes[order]
+        first = np.flatnonzero(np.diff(codes, prepend=-1)) if len(codes) else np.zeros(0, dtype=np.int64)
+        offsets = np.append(first, len(rows))
+        return self.sop_uid.categories[codes[first]].astype(object), offsets, rows
+
+    def frame(self, rows=None, points=False):
+        """
+        Returns the rows as a DataFrame with the column names of parse plus 'Patient' and the
+        characteristics of the nodule (0 for small and non nodules). points=True adds
+        'List of ROI points' as (n, 2) arrays.
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        c = self.columns
+        df = pd.DataFrame({
+            "Patient": self.patient.categories[self.patient.codes[rows]].astype(object),
+            "Radiologist No.": c['radiologist'][rows], "Nodule Type": c['nodule_type'][rows].astype(object),
+            "No.": c['nodule_no'][rows], "Nodule ID": c['nodule_id'][rows], "Inclusion": c['inclusion'][rows],
+            "Z-Coordinate": c['z'][rows], "SOP-UID": c['sop_uid'][rows], "No. of ROI points": c['n_points'][rows],
+            "xmin": c['xmin'][rows], "ymin": c['ymin'][rows], "xmax": c['xmax'][rows], "ymax": c['ymax'][rows],
+            "cx": c['cx'][rows], "cy": c['cy'][rows]}
+            | {key: c[key][rows] for key in CHARACTERISTIC_KEYS}, index=rows)
+        if points:
+            df["List of ROI points"] = [self.points(row) for row in rows]
+        return df
+
+    def join(self, df, rows=None, on='SOP-UID', how='inner'):
+        """
+        Joins df (e.g. SopIndex.patient_frame() with the file of every SOP-UID) with the given rows
+        of the table on column on, as one hash join.
+        """
+        return df.merge(self.frame(rows), on=on, how=how)
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import pandas as pd
+import pydicom
+from instrumentation import Progress
+
+# Persistent SOPInstanceUID -> DICOM file index of a LIDC-IDRI tree.
+# Headers are read once (without pixel data) and re-read only for files whose mtime or size changed.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slices (
+    path TEXT PRIMARY KEY,
+    patient TEXT,
+    series_uid TEXT,
+    sop_uid TEXT,
+    z REAL,
+    mtime REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS slices_sop_uid ON slices (sop_uid);
+CREATE INDEX IF NOT EXISTS slices_patient ON slices (patient);
+"""
+
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+
+class SopIndex:
+    def __init__(self, db_path):
+        """
+        Opens (or creates) the index stored in the SQLite file db_path. Use ':memory:' for a
+        throw-away index. The database should not be placed inside the dataset tree.
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, root):
+        """
+        Indexes every .dcm file below root. The patient of a file is the first folder below root.
+
+        Returns:
+        - (number of files (re)indexed, number of stale entries removed)
+        """
+        root = os.path.abspath(root)
+        prefix = os.path.join(root, '')
+        known = {path: (mtime, size) for path, mtime, size in self.conn.execute(
+            "SELECT path, mtime, size FROM slices WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))}
+
+        rows = []
+        seen = set()
+        progress = Progress("Indexed DICOM files")  # Rate-limited lines on long scans, the total is returned
+        for dirpath, _, files in os.walk(root):
+            for f in files:
+                if not f.lower().endswith('.dcm'):
+                    continue
+                path = os.path.join(dirpath, f)
+                seen.add(path)
+                st = os.stat(path)
+                if known.get(path) == (st.st_mtime, st.st_size):
+                    continue
+                try:
+                    ds = pydicom.dcmread(path, stop_before_pixels=True)
+                except Exception as e:
+                    print(f"Error reading {path}: {e}")
+                    continue
+                patient = os.path.relpath(path, root).split(os.sep)[0]
+                z = float(ds.ImagePositionPatient[2]) if 'ImagePositionPatient' in ds else None
+                rows.append((path, patient, ds.get('SeriesInstanceUID'), ds.get('SOPInstanceUID'),
+                             z, st.st_mtime, st.st_size))
+                progress.update(item=patient)
+
+        stale = [(path,) for path in known if path not in seen]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO slices VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.executemany("DELETE FROM slices WHERE path = ?", stale)
+        return len(rows), len(stale)
+
+    def lookup(self, sop_uid):
+        # Returns the path of the file with this SOPInstanceUID or None
+        row = self.conn.execute("SELECT path FROM slices WHERE sop_uid = ?", (sop_uid,)).fetchone()
+        return row[0] if row else None
+
+    def lookup_many(self, sop_uids):
+        # Returns a dictionary SOPInstanceUID -> path for the UIDs present in the index
+        uids = list(set(sop_uids))
+        found = {}
+        for i in range(0, len(uids), 500):  # Stay below the SQLite host parameter limit
+            chunk = uids[i:i + 500]
+            query = f"SELECT sop_uid, path FROM slices WHERE sop_uid IN ({','.join('?' * len(chunk))})"
+            found.update(self.conn.execute(query, chunk).fetchall())
+        return found
+
+    def patient_frame(self, patient=None):
+        """
+        Returns a DataFrame with the columns 'Patient', 'Series-UID', 'SOP-UID', 'Z-Coordinate',
+        'File' ("<patient>/<file name without .dcm>") and 'Path', for one or all patients.
+        """
+        query = "SELECT patient, series_uid, sop_uid, z, path FROM slices"
+        params = ()
+        if patient is not None:
+            query += " WHERE patient = ?"
+            params = (patient,)
+        df = pd.DataFrame(self.conn.execute(query + " ORDER BY patient, z", params).fetchall(),
+                          columns=['Patient', 'Series-UID', 'SOP-UID', 'Z-Coordinate', 'Path'])
+        names = df['Path'].map(lambda p: os.path.splitext(os.path.basename(p))[0])
+        df.insert(4, 'File', df['Patient'] + '/' + names)
+        return df
+
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+
+def build_index(root, db_path):
+    # Opens the index at db_path and brings it up to date with the tree at root
+    index = SopIndex(db_path)
+    updated, removed = index.update(root)
+    print(f"SOP index {db_path}: {updated} files indexed, {removed} removed.")
+    return index